@@ -1,8 +1,10 @@
-from contextlib import closing
+from contextlib import closing, contextmanager
 from sqlite3 import dbapi2 as sqlite3
 from flask import Flask, request, session, g, redirect, url_for, abort, \
-     render_template, flash, jsonify
-from flask_sqlalchemy import SQLAlchemy
+     render_template, flash, jsonify, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
 from flask_login import LoginManager
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
@@ -12,13 +14,67 @@ from localsettings import SETTINGS
 DEBUG = SETTINGS["DEBUG"]
 # SQLALCHEMY_DATABASE_URI = 'sqlite:////tmp/openthink.db'
 SQLALCHEMY_DATABASE_URI = SETTINGS["DB_CONNECTION_STRING"]
+SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": SETTINGS.get("DB_POOL_PRE_PING", True)}
+if not SQLALCHEMY_DATABASE_URI.startswith("sqlite"):
+    SQLALCHEMY_ENGINE_OPTIONS.update(
+        pool_size=SETTINGS.get("DB_POOL_SIZE", 10),
+        max_overflow=SETTINGS.get("DB_MAX_OVERFLOW", 20),
+        pool_recycle=SETTINGS.get("DB_POOL_RECYCLE", 1800))
+# an optional replica that GET requests read from, see RoutingSession
+SQLALCHEMY_BINDS = {}
+if SETTINGS.get("DB_READ_CONNECTION_STRING"):
+    SQLALCHEMY_BINDS["read"] = SETTINGS["DB_READ_CONNECTION_STRING"]
 
 SECRET_KEY = 'why would I tell you my secret key?'
 
+SQLITE_PRAGMAS = SETTINGS.get("SQLITE_PRAGMAS", {})
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+class RoutingSession(SignallingSession):
+    """Sends the queries of GET and HEAD requests to the "read" bind when
+    one is configured. Everything else, anything flushed, and reads inside
+    primary_reads() go to the primary."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if "read" in SQLALCHEMY_BINDS and not self._flushing and \
+                not self.info.get("primary_reads") and \
+                has_request_context() and request.method in ("GET", "HEAD"):
+            return self.db.get_engine(self.app, bind="read")
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
 app = Flask(__name__)
 app.config.from_object(__name__)
 
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
+
+@contextmanager
+def primary_reads():
+    """Read from the primary inside this block, even during a GET. For
+    reads whose result is stored under a post version (cached state,
+    ETags): a lagging replica would file old rows under the new version."""
+    info = db.session().info
+    depth = info.get("primary_reads", 0)
+    info["primary_reads"] = depth + 1
+    try:
+        yield
+    finally:
+        info["primary_reads"] = depth
 login_manager = LoginManager(app)
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -0,0 +1,5 @@
+"""
+Benchmarks for the server.  Run them from the server directory, e.g.
+
+    python -m benchmarks.transit_encoding
+"""
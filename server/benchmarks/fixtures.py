@@ -0,0 +1,36 @@
+"""
+Helpers shared by the benchmarks: a scratch or existing database and
+percentiles.
+"""
+import os
+import tempfile
+
+from app import app, db
+
+
+def scratch_app(path=None):
+    """Point the app at a fresh sqlite file and create the tables. Must run
+    before anything else touches the database. Returns the app."""
+    import main  # registers the views blueprint
+    from db_models import setup_db
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix=".db", prefix="openthink-bench-")
+        os.close(fd)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    with app.app_context():
+        setup_db(drop_tables_first=True)
+    return app
+
+def open_app(path):
+    """Point the app at an existing sqlite file, e.g. one made by
+    benchmarks.generate. Returns the app."""
+    import main  # registers the views blueprint
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.abspath(path)
+    return app
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
@@ -0,0 +1,210 @@
+"""
+Fill a database with synthetic users, posts, links, comments and votes.
+
+    python -m benchmarks.generate --db bench.db --posts 100000 --votes 1000000
+
+Every post is linked under an earlier one picked by preferential
+attachment, so a few posts collect most of the children, as popular
+questions do. Extra links, comments and votes follow the same skew.
+Links always point from an older post to a newer one, so the graph
+stays acyclic. Rows go in with executemany batches and explicit ids,
+like bulk.Importer. The derived data (vote totals, hot scores, action
+counters, the closure table and the search index) is rebuilt once at
+the end.
+Every user's password is PASSWORD.
+"""
+import argparse
+import datetime as dt
+import random
+import time
+
+from sqlalchemy import func
+
+from app import db
+from db_models import User, Post, Relation, Comment, Vote, PostClosure, make_excerpt
+import passwords
+import search
+from benchmarks.fixtures import scratch_app
+
+PASSWORD = "benchmark"
+WORDS = ("why", "how", "does", "the", "a", "water", "light", "brain", "market",
+         "learn", "energy", "language", "history", "memory", "cells", "stars",
+         "music", "sleep", "money", "climate", "code", "proof", "theory", "city")
+DEFAULTS = {"users": 1000, "posts": 10000, "links": 15000, "comments": 30000,
+            "votes": 100000}
+
+
+def sentence(rand, words):
+    return " ".join(rand.choice(WORDS) for _ in range(words))
+
+
+class Generator(object):
+
+    def __init__(self, seed=0, batch=10000, days=365):
+        self.rand = random.Random(seed)
+        self.batch = batch
+        self.start = dt.datetime.utcnow() - dt.timedelta(days=days)
+        self.span = days * 86400.0
+        self.counts = {}
+
+    def insert(self, model, rows):
+        """Insert an iterable of row dicts in batches."""
+        table, pending, count = model.__table__, [], 0
+        for row in rows:
+            pending.append(row)
+            if len(pending) >= self.batch:
+                db.session.execute(table.insert(), pending)
+                count += len(pending)
+                pending = []
+        if pending:
+            db.session.execute(table.insert(), pending)
+            count += len(pending)
+        db.session.commit()
+        self.counts[table.name] = self.counts.get(table.name, 0) + count
+
+    def time_at(self, fraction):
+        return self.start + dt.timedelta(seconds=fraction * self.span)
+
+    def users(self, n):
+        password = passwords.hash_password(PASSWORD)
+        first = self.next_id(User)
+        self.user_ids = list(range(1, first + n))
+        self.insert(User, ({"id": i, "username": "user%d" % i,
+                            "email": "user%d@example.com" % i,
+                            "password": password, "active": True,
+                            "created_at": self.start, "is_admin": False}
+                           for i in range(first, first + n)))
+
+    def posts(self, n):
+        first = self.next_id(Post)
+        self.post_ids = list(range(1, first + n))
+        rand = self.rand
+        def rows():
+            for i in range(first, first + n):
+                body = sentence(rand, rand.randint(10, 120))
+                yield {"id": i, "title": "%s %d" % (sentence(rand, 5), i),
+                       "body": body, "excerpt": make_excerpt(body),
+                       "user_id": rand.choice(self.user_ids),
+                       "time_posted": self.time_at(float(i - first) / n),
+                       "url": "post-%d" % i,
+                       "comment_count": 0, "link_count": 0}
+        self.insert(Post, rows())
+
+    def links(self, n):
+        """One link under an earlier post for every post but the root, then
+        extra links from skewed parents to random newer posts."""
+        rand = self.rand
+        # every post appears once, plus once per child it has, so a choice
+        # from popular is a choice weighted by child count
+        popular = [self.post_ids[0]]
+        pairs = set()
+        def tree():
+            for index, child_id in enumerate(self.post_ids[1:], 1):
+                parent_id = popular[rand.randrange(len(popular))]
+                pairs.add((parent_id, child_id))
+                popular.append(parent_id)
+                popular.append(child_id)
+                yield parent_id, child_id, float(index) / len(self.post_ids)
+        def extra(count):
+            last = self.post_ids[-1]
+            attempts = count * 10
+            while count > 0 and attempts > 0:
+                attempts -= 1
+                parent_id = popular[rand.randrange(len(popular))]
+                if parent_id >= last:
+                    continue
+                child_id = rand.randint(parent_id + 1, last)
+                if (parent_id, child_id) in pairs:
+                    continue
+                pairs.add((parent_id, child_id))
+                popular.append(parent_id)
+                count -= 1
+                yield parent_id, child_id, rand.uniform(
+                    float(child_id - 1) / last, 1.0)
+        def rows():
+            edges = list(tree())
+            edges.extend(extra(n - len(edges)))
+            edges.sort(key=lambda edge: edge[2])
+            for rel_id, (parent_id, child_id, when) in enumerate(edges, self.next_id(Relation)):
+                yield {"id": rel_id, "parent_id": parent_id, "child_id": child_id,
+                       "linked_by_id": rand.choice(self.user_ids),
+                       "time_linked": self.time_at(when), "votecount": 0}
+        self.insert(Relation, rows())
+        self.popular = popular
+
+    def comments(self, n):
+        rand = self.rand
+        first = self.next_id(Comment)
+        times = sorted(rand.random() for _ in range(n))
+        self.insert(Comment, ({"id": i, "body": sentence(rand, rand.randint(3, 40)),
+                               "post_id": self.popular[rand.randrange(len(self.popular))],
+                               "user_id": rand.choice(self.user_ids),
+                               "time_posted": self.time_at(when)}
+                              for i, when in enumerate(times, first)))
+
+    def votes(self, n):
+        """Votes skewed towards the oldest links, at most one per user and
+        link, three quarters of them up."""
+        rand = self.rand
+        rel_ids = [rel_id for (rel_id,) in db.session.query(Relation.id)
+                                                          .order_by(Relation.id)]
+        users = len(self.user_ids)
+        n = min(n, len(rel_ids) * users)
+        seen = set()
+        def rows():
+            while len(seen) < n:
+                rel_id = rel_ids[int(len(rel_ids) * rand.random() ** 3)]
+                user_id = self.user_ids[rand.randrange(users)]
+                key = rel_id * (users + 1) + user_id
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield {"rel_id": rel_id, "user_id": user_id,
+                       "value": 1 if rand.random() < 0.75 else -1}
+        self.insert(Vote, rows())
+
+    def next_id(self, model):
+        return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+    def finish(self):
+        Relation.reconcile_votecounts()
+        Relation.rebuild_hot_scores()
+        Post.rebuild_action_counts()
+        PostClosure.rebuild()
+        search.rebuild_index()
+
+
+def generate(path=None, users=DEFAULTS["users"], posts=DEFAULTS["posts"],
+             links=DEFAULTS["links"], comments=DEFAULTS["comments"],
+             votes=DEFAULTS["votes"], seed=0, batch=10000):
+    """Create a fresh database at path (a temp file if None) and fill it.
+    Returns (app, path, row counts)."""
+    app = scratch_app(path)
+    path = app.config["SQLALCHEMY_DATABASE_URI"][len("sqlite:///"):]
+    with app.app_context():
+        gen = Generator(seed=seed, batch=batch)
+        for step, count in (("users", users), ("posts", posts), ("links", links),
+                            ("comments", comments), ("votes", votes)):
+            started = time.time()
+            getattr(gen, step)(count)
+            print("%-9s %9d rows in %6.1f s" % (step, count, time.time() - started))
+        started = time.time()
+        gen.finish()
+        print("%-9s %20.1f s" % ("derived", time.time() - started))
+        return app, path, gen.counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", help="sqlite file to create (overwritten)")
+    for name, default in sorted(DEFAULTS.items()):
+        parser.add_argument("--" + name, type=int, default=default)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch", type=int, default=10000)
+    args = parser.parse_args()
+    _, path, counts = generate(args.db, users=args.users, posts=args.posts,
+                               links=args.links, comments=args.comments,
+                               votes=args.votes, seed=args.seed, batch=args.batch)
+    print("wrote %s: %s" % (path, ", ".join("%s %d" % item for item in sorted(counts.items()))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Latency of page reads while a burst of logins runs, with bcrypt on the
+request threads (PASSWORD_WORKERS = 0) and in the password process pool.
+
+    python -m benchmarks.login_storm [login threads] [seconds]
+"""
+import sys
+import threading
+import time
+from io import StringIO
+
+from transit.writer import Writer
+
+import passwords
+from benchmarks.fixtures import scratch_app, percentile
+
+
+def transit_body(val):
+    io = StringIO()
+    Writer(io, "json").write(val)
+    return io.getvalue()
+
+def storm(app, workers, login_threads, seconds):
+    passwords.pool = passwords.PasswordPool(workers=workers)
+    stop = threading.Event()
+    body = transit_body({"username": "storm", "password": "storm-password"})
+    logins = [0]
+
+    def login_loop():
+        client = app.test_client()
+        while not stop.is_set():
+            client.post("/login", data=body)
+            logins[0] += 1
+
+    threads = [threading.Thread(target=login_loop) for _ in range(login_threads)]
+    for t in threads:
+        t.start()
+    reader = app.test_client()
+    latencies = []
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        start = time.time()
+        reader.get("/actions/1?page=1")
+        latencies.append((time.time() - start) * 1000)
+    stop.set()
+    for t in threads:
+        t.join()
+    passwords.pool.shutdown()
+    return latencies, logins[0]
+
+def main(login_threads=8, seconds=5):
+    app = scratch_app()
+    with app.app_context():
+        from db_models import User
+        User.create(username="storm", email="storm@example.com",
+                    password="storm-password")
+    for label, workers, threads in (("no logins", 0, 0),
+                                    ("inline bcrypt", 0, login_threads),
+                                    ("process pool", passwords.WORKERS, login_threads)):
+        latencies, logins = storm(app, workers, threads, seconds)
+        print("%-14s reads: %6d  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  "
+              "logins: %d" % (label, len(latencies), percentile(latencies, 50),
+                              percentile(latencies, 95), percentile(latencies, 99),
+                              logins))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
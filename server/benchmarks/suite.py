@@ -0,0 +1,313 @@
+"""
+Latency, SQL statements and peak memory of the hot queries, the view
+helpers and every route, measured against a generated database.
+
+    python -m benchmarks.suite --db bench.db --out results.json
+    python -m benchmarks.suite --db bench.db --compare results.json
+
+Without --db a small database is generated first. Every case runs a
+few warmup calls and then --iterations timed calls. It reports the
+p50/p95/p99 latency, the median number of SQL statements per call, and
+the peak Python memory of one extra call traced with tracemalloc.
+Queries and views run against three sample posts: the one with the
+most links, a middling one and a leaf. Routes go through the test
+client as a logged-in user. The write routes run last and change the
+database, so point --db at a copy you don't mind changing.
+"""
+import argparse
+import datetime as dt
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from io import StringIO
+
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+from transit.writer import Writer
+
+from app import db
+from db_models import User, Post, Relation, Comment, Vote
+from db_queries import child_rel_query, child_rel_rows, post_actions, \
+     post_action_rows, total_actions, listing_post_dicts, rel_writeable, with_vote_values
+from localsettings import SETTINGS
+import views
+from benchmarks.fixtures import open_app, percentile
+from benchmarks import generate
+
+
+class StatementCounter(object):
+    """Counts statements run on any engine, including the read replica."""
+
+    def __init__(self):
+        self.count = 0
+        event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+
+    def before_cursor_execute(self, *args):
+        self.count += 1
+
+counter = StatementCounter()
+
+def transit_body(val):
+    io = StringIO()
+    Writer(io, "json").write(val)
+    return io.getvalue()
+
+def measure(fn, iterations, warmup=2, setup=None):
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+    samples, statements, errors = [], [], 0
+    for _ in range(iterations):
+        if setup:
+            setup()
+        counter.count = 0
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+        statements.append(counter.count)
+        if getattr(result, "status_code", 200) >= 400:
+            errors += 1
+    if setup:
+        setup()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"iterations": iterations,
+            "p50_ms": percentile(samples, 50), "p95_ms": percentile(samples, 95),
+            "p99_ms": percentile(samples, 99),
+            "mean_ms": sum(samples) / len(samples), "max_ms": max(samples),
+            "statements": percentile(statements, 50),
+            "peak_kb": peak / 1024.0, "errors": errors}
+
+def sample_posts():
+    """The post with the most links, a middling one and a leaf, by id."""
+    busiest = db.session.query(Post.id).order_by(Post.link_count.desc(),
+                                                 Post.id).first()[0]
+    linked = db.session.query(Post.id).filter(Post.link_count > 0) \
+                       .order_by(Post.link_count, Post.id)
+    middling = linked.offset(linked.count() // 2).first()[0]
+    leaf = db.session.query(Post.id).filter(Post.link_count == 0) \
+                     .order_by(Post.id.desc()).first()[0]
+    return {"busiest": busiest, "middling": middling, "leaf": leaf}
+
+def orm_child_page(post_id):
+    """A page of 8 children built from ORM objects, as the views did
+    before db_queries had column reads."""
+    rels = child_rel_query(post_id)
+    posts = Post.query.filter(Post.id.in_([r.child_id for r in rels])).all() if rels else []
+    return ([p.writeable for p in posts],
+            with_vote_values([r.writeable for r in rels]))
+
+def column_child_page(post_id):
+    """The same page from column rows, as the views build it now."""
+    rels = child_rel_rows(post_id)
+    return (listing_post_dicts([r.child_id for r in rels]),
+            with_vote_values([rel_writeable(r) for r in rels]))
+
+def orm_action_page(post_id, page):
+    """A page of 20 actions built from ORM objects, as the views did
+    before db_queries had column reads."""
+    rows = post_action_rows(post_id, page=page)
+    rel_ids = [row[0] for row in rows if row[2] == "Relation"]
+    comment_ids = [row[0] for row in rows if row[2] == "Comment"]
+    rels = Relation.query.filter(Relation.id.in_(rel_ids)).all() if rel_ids else []
+    posts = Post.query.filter(Post.id.in_([r.child_id for r in rels])).all() if rels else []
+    comments = Comment.query.filter(Comment.id.in_(comment_ids)).all() if comment_ids else []
+    return (with_vote_values([r.writeable for r in rels]), [p.writeable for p in posts],
+            [c.writeable for c in comments])
+
+def query_cases(samples):
+    """(name, fn[, setup]) for the queries and view helpers; they need a
+    request context, which run() provides. The page builders start each
+    call from an empty session, like a new request."""
+    cases = []
+    for label, post_id in sorted(samples.items()):
+        def last_page(post_id=post_id):
+            return max(1, -(-total_actions(post_id) // views.ACTIONS_PER_PAGE))
+        state = views.handle_asks(post_id, ["children", "actions"])
+        fresh = db.session.expunge_all
+        cases += [
+            ("child_rel_query top [%s]" % label,
+             lambda post_id=post_id: child_rel_query(post_id, sort_by='top')),
+            ("child_rel_query new [%s]" % label,
+             lambda post_id=post_id: child_rel_query(post_id, sort_by='new')),
+            ("child_rel_query hot [%s]" % label,
+             lambda post_id=post_id: child_rel_query(post_id, sort_by='hot')),
+            ("post_actions [%s]" % label,
+             lambda post_id=post_id: post_actions(post_id, page=last_page(post_id))),
+            ("total_actions [%s]" % label,
+             lambda post_id=post_id: total_actions(post_id)),
+            ("child page orm [%s]" % label,
+             lambda post_id=post_id: orm_child_page(post_id), fresh),
+            ("child page columns [%s]" % label,
+             lambda post_id=post_id: column_child_page(post_id), fresh),
+            ("action page orm [%s]" % label,
+             lambda post_id=post_id: orm_action_page(post_id, last_page(post_id)), fresh),
+            ("action page columns [%s]" % label,
+             lambda post_id=post_id: views.actions_with_data(
+                 post_id, last_page(post_id), user=None), fresh),
+            ("handle_asks cached [%s]" % label,
+             lambda post_id=post_id: views.handle_asks(post_id, ["children", "actions"])),
+            ("build_asks [%s]" % label,
+             lambda post_id=post_id: views.build_asks(post_id, ["children", "actions"])),
+            ("transitify json [%s]" % label,
+             lambda state=state: views.transitify(state, "json")),
+            ("transitify msgpack [%s]" % label,
+             lambda state=state: views.transitify(state, "msgpack")),
+        ]
+    return cases
+
+def read_route_cases(client, samples):
+    cases = [("GET /", lambda: client.get("/")),
+             ("GET /search", lambda: client.get("/search?q=memory+energy"))]
+    for label, post_id in sorted(samples.items()):
+        url = db.session.query(Post.url).filter(Post.id == post_id).scalar()
+        def not_modified(path):
+            etag = client.get(path).headers["ETag"]
+            return lambda: client.get(path, headers={"If-None-Match": etag})
+        cases += [(name % label, fn) for name, fn in (
+            ("GET /post-by-id data-only [%s]",
+             lambda post_id=post_id: client.get("/post-by-id/%d?data-only=1" % post_id)),
+            ("GET /post/<url> [%s]", lambda url=url: client.get("/post/%s" % url)),
+            ("GET /actions [%s]", lambda post_id=post_id: client.get("/actions/%d" % post_id)),
+            ("GET /actions page 1 [%s]",
+             lambda post_id=post_id: client.get("/actions/%d?page=1" % post_id)),
+            ("GET /actions 304 [%s]", not_modified("/actions/%d" % post_id)),
+            ("GET /links top [%s]", lambda post_id=post_id: client.get("/links/%d" % post_id)),
+            ("GET /links new [%s]",
+             lambda post_id=post_id: client.get("/links/%d?sort=new" % post_id)),
+            ("GET /links hot [%s]",
+             lambda post_id=post_id: client.get("/links/%d?sort=hot" % post_id)),
+            ("GET /ancestors [%s]",
+             lambda post_id=post_id: client.get("/post/%d/ancestors" % post_id)),
+            ("GET /descendants [%s]",
+             lambda post_id=post_id: client.get("/post/%d/descendants" % post_id)),
+        )]
+    batch = transit_body([{"post_id": post_id, "asks": ["children", "actions"]}
+                          for post_id in sorted(samples.values())])
+    cases.append(("POST /batch [all]", lambda: client.post("/batch", data=batch)))
+    return cases
+
+def write_route_cases(client, samples):
+    parent_id = samples["busiest"]
+    rel_id = db.session.query(Relation.id).filter(Relation.parent_id == parent_id) \
+                       .order_by(Relation.id).first()[0]
+    linked = set(child_id for (child_id,) in db.session.query(Relation.child_id)
+                                                 .filter(Relation.parent_id == parent_id))
+    unlinked = (post_id for (post_id,) in db.session.query(Post.id)
+                                                    .filter(Post.id > parent_id)
+                                                    .order_by(Post.id.desc())
+                                                    .limit(len(linked) + 1000)
+                if post_id not in linked)
+    registered = [0]
+    def register():
+        registered[0] += 1
+        return client.post("/register", data=transit_body({
+            "username": "bench%d%d" % (time.time(), registered[0]),
+            "email": "bench%d%d@example.com" % (time.time(), registered[0]),
+            "password": "bench-password", "r-password": "bench-password"}))
+    login_body = transit_body({"username": "user2", "password": generate.PASSWORD})
+    return [
+        ("POST /vote", lambda: client.post("/vote", data=transit_body(
+            {"rel_id": rel_id, "value": 1}))),
+        ("POST /post/<id>/comment", lambda: client.post(
+            "/post/%d/comment" % parent_id, data=transit_body({"body": "benchmark comment"}))),
+        ("POST /submit-post", lambda: client.post("/submit-post", data=transit_body(
+            {"title": "benchmark post", "text": "benchmark body", "parent": parent_id}))),
+        ("POST /link-post", lambda: client.post("/link-post", data=transit_body(
+            {"parent": parent_id, "child-text": str(next(unlinked))}))),
+        ("POST /logout", lambda: client.post("/logout"),
+         lambda: client.post("/login", data=login_body)),
+        ("POST /login", lambda: client.post("/login", data=login_body)),
+        ("POST /register", register),
+    ]
+
+def table_counts():
+    return dict((model.__tablename__, db.session.query(func.count()).select_from(model).scalar())
+                for model in (User, Post, Relation, Comment, Vote))
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(app, iterations, slow_iterations):
+    results = {}
+    def record(name, fn, count=iterations, setup=None):
+        try:
+            r = results[name] = measure(fn, count, setup=setup)
+        except Exception as e:
+            # e.g. the html routes when the templates aren't deployed
+            results[name] = {"failed": "%s: %s" % (type(e).__name__, e)}
+            print("%-40s failed: %s" % (name, results[name]["failed"]))
+            return
+        print("%-40s p50 %8.2f  p95 %8.2f  p99 %8.2f ms  %4d sql  %9.1f KB%s" % (
+            name, r["p50_ms"], r["p95_ms"], r["p99_ms"], r["statements"],
+            r["peak_kb"], "  %d errors" % r["errors"] if r["errors"] else ""))
+    with app.test_request_context():
+        samples = sample_posts()
+        meta = {"commit": git_commit(), "date": dt.datetime.utcnow().isoformat(),
+                "python": platform.python_version(), "samples": samples,
+                "rows": table_counts(), "cache": SETTINGS.get("CACHE_BACKEND"),
+                "iterations": iterations}
+        for case in query_cases(samples):
+            record(case[0], case[1], setup=case[2] if len(case) > 2 else None)
+    client = app.test_client()
+    client.post("/login", data=transit_body({"username": "user2",
+                                            "password": generate.PASSWORD}))
+    with app.app_context():
+        read_cases = read_route_cases(client, samples)
+        write_cases = write_route_cases(client, samples)
+    for name, fn in read_cases:
+        record(name, fn)
+    for case in write_cases:
+        name, fn = case[:2]
+        slow = name in ("POST /login", "POST /register", "POST /logout")
+        record(name, fn, slow_iterations if slow else iterations,
+               setup=case[2] if len(case) > 2 else None)
+    return {"meta": meta, "results": results}
+
+def compare(old, new):
+    print("\n%-40s %10s %10s %8s %10s" % ("vs " + str(old["meta"].get("commit")),
+                                          "p50 before", "p50 now", "change", "sql"))
+    for name, result in sorted(new["results"].items()):
+        before = old["results"].get(name)
+        if before is None or "failed" in before or "failed" in result:
+            continue
+        change = (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100 \
+            if before["p50_ms"] else 0.0
+        print("%-40s %10.2f %10.2f %+7.0f%% %4d -> %d" % (
+            name, before["p50_ms"], result["p50_ms"], change,
+            before["statements"], result["statements"]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", help="database made by benchmarks.generate")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--slow-iterations", type=int, default=5,
+                        help="iterations for login, logout and register (bcrypt)")
+    parser.add_argument("--out", help="write the results as JSON here")
+    parser.add_argument("--compare", help="results JSON from an earlier run")
+    args = parser.parse_args()
+    if args.db:
+        app = open_app(args.db)
+    else:
+        app = generate.generate()[0]
+    results = run(app, args.iterations, args.slow_iterations)
+    results["meta"]["db"] = args.db
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Encode time and payload size of a typical handle_asks result: 8 children
+and a full page of 20 actions.  Compares building a fresh transit Writer
+per response, which transitify does for json, with the reused per-thread
+msgpack writer.
+"""
+import datetime as dt
+import timeit
+from io import StringIO
+
+import pytz
+from transit.writer import Writer
+
+from views import transit_encoder, ACTIONS_PER_PAGE
+
+
+def sample_state(children=8, actions=ACTIONS_PER_PAGE):
+    now = pytz.utc.localize(dt.datetime.utcnow())
+    user = {"username": "someone", "id": 2}
+    post = lambda i: {"id": i, "title": "Post number %s" % i,
+                      "body": "Some body text for post %s. " % i * 12,
+                      "user_id": 2, "time_posted": now, "url": "post-number-%s" % i}
+    rel = lambda i: {"id": i, "parent_id": 1, "child_id": i + 1, "linked_by": user,
+                     "time_linked": now, "votecount": i % 5, "user_vote_value": 0}
+    comment = lambda i: {"id": i, "body": "comment %s" % i, "post_id": 1,
+                         "user": user, "time_posted": now}
+    rel_ids = list(range(1, children + 1)) + \
+        list(range(100, 100 + actions // 2))
+    comment_ids = list(range(1, actions - actions // 2 + 1))
+    return {
+        "current_post": 1,
+        "posts": dict((i + 1, post(i + 1)) for i in rel_ids + [0]),
+        "rels": dict((i, rel(i)) for i in rel_ids),
+        "comments": dict((i, comment(i)) for i in comment_ids),
+        "link_ids": rel_ids[:children],
+        "actions": [[i, "Relation"] for i in rel_ids[children:]] +
+                   [[i, "Comment"] for i in comment_ids],
+        "action_count": actions,
+        "page": 1,
+        "user": user,
+    }
+
+def fresh_writer_json(val):
+    io = StringIO()
+    Writer(io, "json").write(val)
+    return io.getvalue()
+
+def report(name, fn, state, number):
+    payload = fn(state)
+    seconds = min(timeit.repeat(lambda: fn(state), number=number, repeat=5))
+    print("%-22s %8.3f ms/encode %8d bytes" % (name, seconds / number * 1000,
+                                                 len(payload)))
+
+def main(number=200):
+    state = sample_state()
+    report("fresh writer, json", fresh_writer_json, state, number)
+    report("reused writer, msgpack", lambda v: transit_encoder.encode(v, "msgpack"),
+           state, number)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+Streaming bulk export and import of the whole posts graph as NDJSON.
+
+Every line is one JSON object with a "kind" (user, post, relation,
+comment, vote) and that row's columns. Exports stream each table through
+a server-side cursor, so memory stays flat however big the database is.
+Imports insert in large executemany batches with explicit new ids, so the
+ids in the file are remapped without a round trip per row. Slugs are
+allocated in memory against one scan of the existing urls. Derived data
+(vote totals, hot scores, action counters, the closure table, the search
+index) is rebuilt once at the end instead of row by row.
+
+Files must list users before posts, posts before relations and comments,
+and relations before votes, which is the order export writes.
+"""
+import datetime as dt
+import json
+from sqlalchemy import func, text
+from slugify import slugify
+from app import db
+from db_models import User, Post, Relation, Comment, Vote, PostClosure, make_excerpt
+import search
+
+EXPORT_COLUMNS = (
+    ("user", User, ("id", "username", "email", "password", "created_at",
+                    "active", "is_admin")),
+    ("post", Post, ("id", "title", "body", "user_id", "time_posted",
+                    "time_edited", "url")),
+    ("relation", Relation, ("id", "parent_id", "child_id", "linked_by_id",
+                            "time_linked")),
+    ("comment", Comment, ("id", "body", "post_id", "user_id", "time_posted")),
+    ("vote", Vote, ("rel_id", "user_id", "value")),
+)
+TIME_COLUMNS = ("created_at", "time_posted", "time_edited", "time_linked")
+
+def _jsonable(value):
+    if isinstance(value, dt.datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+def _parse_time(value):
+    if value is None:
+        return None
+    fmt = "%Y-%m-%dT%H:%M:%S.%f" if "." in value else "%Y-%m-%dT%H:%M:%S"
+    return dt.datetime.strptime(value, fmt)
+
+def export_ndjson(out, batch=1000):
+    """Write every exported row to the file-like out. Returns the count."""
+    written = 0
+    connection = db.session.connection().execution_options(stream_results=True)
+    for kind, model, columns in EXPORT_COLUMNS:
+        table = model.__table__
+        result = connection.execute(
+            table.select().with_only_columns([table.c[c] for c in columns])
+                          .order_by(*table.primary_key.columns))
+        while True:
+            rows = result.fetchmany(batch)
+            if not rows:
+                break
+            for row in rows:
+                record = dict((c, _jsonable(row[c])) for c in columns)
+                record["kind"] = kind
+                out.write(json.dumps(record) + "\n")
+            written += len(rows)
+    return written
+
+
+class SlugAllocator(object):
+    """make_url for many posts at once, from one scan of the urls in use."""
+
+    def __init__(self):
+        self.taken = set()
+        self.highest = {}
+        for (url,) in db.session.query(Post.url).yield_per(10000):
+            self._take(url)
+
+    def _take(self, url):
+        self.taken.add(url)
+        base, _, suffix = url.rpartition(".")
+        if suffix.isdigit():
+            self.highest[base] = max(self.highest.get(base, 1), int(suffix))
+
+    def allocate(self, title, body, url=None):
+        """The exported url if it's still free, otherwise the next free
+        suffix of the post's slug."""
+        if not url or url in self.taken:
+            url = slugify(title or (body or "")[:140])
+            if url in self.taken:
+                url = "%s.%s" % (url, self.highest.get(url, 1) + 1)
+        self._take(url)
+        return url
+
+
+class Importer(object):
+
+    def __init__(self, batch=10000):
+        self.batch = batch
+        self.ids = {"user": {}, "post": {}, "relation": {}}
+        self.next_id = dict((kind, (db.session.query(func.max(model.id)).scalar() or 0) + 1)
+                            for kind, model in (("user", User), ("post", Post),
+                                                ("relation", Relation),
+                                                ("comment", Comment)))
+        self.pending = dict((kind, []) for kind, _, _ in EXPORT_COLUMNS)
+        self.counts = dict((kind, 0) for kind, _, _ in EXPORT_COLUMNS)
+        self.users_by_name = dict(db.session.query(User.username, User.id))
+        self.users_by_email = dict(db.session.query(User.email, User.id))
+        self.slugs = SlugAllocator()
+
+    def _new_id(self, kind, old_id):
+        new_id = self.next_id[kind]
+        self.next_id[kind] += 1
+        if old_id is not None and kind in self.ids:
+            self.ids[kind][old_id] = new_id
+        return new_id
+
+    def _ref(self, kind, old_id):
+        if old_id is None:
+            return None
+        try:
+            return self.ids[kind][old_id]
+        except KeyError:
+            raise ValueError("%s %s is referenced before it appears" % (kind, old_id))
+
+    def add(self, record):
+        kind = record.pop("kind")
+        for column in TIME_COLUMNS:
+            if column in record:
+                record[column] = _parse_time(record[column])
+        if kind == "user":
+            existing = self.users_by_name.get(record["username"]) or \
+                self.users_by_email.get(record["email"])
+            if existing is not None:
+                self.ids["user"][record["id"]] = existing
+                return
+            record["id"] = self._new_id("user", record["id"])
+            self.users_by_name[record["username"]] = record["id"]
+            self.users_by_email[record["email"]] = record["id"]
+        elif kind == "post":
+            record["id"] = self._new_id("post", record["id"])
+            record["user_id"] = self._ref("user", record["user_id"])
+            record["url"] = self.slugs.allocate(record["title"], record["body"],
+                                                record.get("url"))
+            record["excerpt"] = make_excerpt(record["body"])
+        elif kind == "relation":
+            record["id"] = self._new_id("relation", record["id"])
+            record["parent_id"] = self._ref("post", record["parent_id"])
+            record["child_id"] = self._ref("post", record["child_id"])
+            record["linked_by_id"] = self._ref("user", record["linked_by_id"])
+        elif kind == "comment":
+            record["id"] = self._new_id("comment", record["id"])
+            record["post_id"] = self._ref("post", record["post_id"])
+            record["user_id"] = self._ref("user", record["user_id"])
+        elif kind == "vote":
+            record["rel_id"] = self._ref("relation", record["rel_id"])
+            record["user_id"] = self._ref("user", record["user_id"])
+        else:
+            raise ValueError("unknown kind %r" % kind)
+        self.pending[kind].append(record)
+        if len(self.pending[kind]) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """Insert everything pending, parents first, in one transaction."""
+        for kind, model, _ in EXPORT_COLUMNS:
+            rows = self.pending[kind]
+            if rows:
+                db.session.execute(model.__table__.insert(), rows)
+                self.counts[kind] += len(rows)
+                self.pending[kind] = []
+        db.session.commit()
+
+    def finish(self):
+        self.flush()
+        if db.engine.dialect.name == "postgresql":
+            for table in ("users", "posts", "relations", "comments"):
+                db.session.execute(text(
+                    "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                    "(SELECT MAX(id) FROM %s))" % (table, table)))
+            db.session.commit()
+        Relation.reconcile_votecounts()
+        Relation.rebuild_hot_scores()
+        Post.rebuild_action_counts()
+        PostClosure.rebuild()
+        search.rebuild_index()
+        return self.counts
+
+def import_ndjson(lines, batch=10000):
+    """Import NDJSON lines from an iterable. Returns rows inserted per kind."""
+    importer = Importer(batch=batch)
+    for line in lines:
+        line = line.strip()
+        if line:
+            importer.add(json.loads(line))
+    return importer.finish()
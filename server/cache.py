@@ -0,0 +1,160 @@
+"""
+Small pluggable cache used for rendered post state.
+
+Two backends share the same interface (get, set, delete): ``LRUCache``
+keeps everything in this process, ``SQLiteCache`` keeps it in a local
+sqlite file so every worker on the machine shares the same entries.  Pick
+one with SETTINGS["CACHE_BACKEND"] ("lru", "sqlite" or "none").
+
+Cached post state is keyed by the version stored on the post row
+(Post.version), which every write bumps in its own transaction, so
+entries never need invalidating: a write in any worker, or in a manage.py
+command, makes the old keys unreachable everywhere. The backend only
+decides how often a worker finds what another already built; with
+several workers per machine, "sqlite" shares them.
+"""
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from localsettings import SETTINGS
+
+
+class NullCache(object):
+    """Caches nothing."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        return default
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+class LRUCache(NullCache):
+    """In-process cache that drops the least recently used entry once it
+    holds more than maxsize values, and entries older than ttl seconds
+    when ttl is set. Counts hits and misses."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache(object):
+    """Cache shared between processes through a local sqlite file.
+    Values are pickled; each thread gets its own connection. Beyond
+    maxsize entries it drops the least recently used ones. A hit marks
+    its entry used at most every TOUCH_EVERY seconds, so hot keys don't
+    cost a write per read."""
+
+    PRUNE_EVERY = 100
+    TOUCH_EVERY = 30
+
+    def __init__(self, path, maxsize=10000):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._sets = 0
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache "
+                         "(key TEXT PRIMARY KEY, value BLOB, touched REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_touched "
+                         "ON cache (touched)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=None):
+        row = self._conn().execute("SELECT value, touched FROM cache WHERE key = ?",
+                                   (key,)).fetchone()
+        if row is None:
+            return default
+        now = time.time()
+        if row[1] < now - self.TOUCH_EVERY:
+            with self._conn() as conn:
+                conn.execute("UPDATE cache SET touched = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, touched) "
+                         "VALUES (?, ?, ?)", (key, sqlite3.Binary(blob), time.time()))
+        self._sets += 1
+        if self._sets % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def delete(self, key):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def prune(self):
+        """Drop the least recently used entries beyond maxsize."""
+        with self._conn() as conn:
+            conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                         "ORDER BY touched DESC LIMIT -1 OFFSET ?)", (self.maxsize,))
+
+
+def make_cache(settings=SETTINGS):
+    backend = settings.get("CACHE_BACKEND", "lru")
+    if backend == "sqlite":
+        path = settings.get("CACHE_PATH") or \
+            os.path.join(tempfile.gettempdir(), "openthink-cache.db")
+        return SQLiteCache(path, maxsize=settings.get("CACHE_SIZE", 10000))
+    if backend in (None, "none"):
+        return NullCache()
+    return LRUCache(maxsize=settings.get("CACHE_SIZE", 1024))
+
+cache = make_cache()
@@ -2,19 +2,26 @@ import datetime as dt
 import pytz
 import string
 import random
+import threading
 
 from localsettings import SETTINGS
 from flask import Flask
-from flask_bcrypt import Bcrypt
 from flask_login import UserMixin
+from sqlalchemy import bindparam, DDL
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.sql import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
 # from sqlalchemy import and_
 import re
 from app import db, login_manager
+import events
+import search
+import passwords
+from cache import LRUCache
 from slugify import slugify
 
-bcrypt = Bcrypt()
-
 def doc_or_doc_id(docname, value, dict_to_update=None):
     dict_to_update = dict_to_update or {}
     if isinstance(value, int):
@@ -31,6 +38,86 @@ class SurrogatePK(object):
 
     id = db.Column(db.Integer, primary_key=True)
 
+class UnitOfWork(threading.local):
+    """Groups several writes into one transaction. Inside a
+    ``with unit_of_work:`` block, save, delete and the model write methods
+    flush instead of committing, and the outermost block commits once on
+    the way out, or rolls everything back if it raised or rollback() was
+    called. Blocks nest, so a write method can use one whether or not its
+    caller already has.
+
+    On sqlite the outermost block opens the transaction with BEGIN
+    IMMEDIATE. That takes the write lock up front, waiting up to
+    busy_timeout, so the block can't fail halfway on a stale read
+    snapshot. It also puts savepoints inside a real transaction: under
+    pysqlite's implicit transactions, releasing a savepoint commits."""
+
+    def __init__(self):
+        self.depth = 0
+        self.failed = False
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.failed = False
+            connection = db.session.connection()
+            if connection.dialect.name == "sqlite" and \
+                    not connection.connection.in_transaction:
+                connection.exec_driver_sql("BEGIN IMMEDIATE")
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            if exc_type is None and not self.failed:
+                db.session.commit()
+            else:
+                db.session.rollback()
+        return False
+
+    def commit(self):
+        """Commit, or only flush inside a block."""
+        if self.depth:
+            db.session.flush()
+        else:
+            db.session.commit()
+
+    def rollback(self):
+        """Undo everything written so far; the block commits nothing."""
+        db.session.rollback()
+        if self.depth:
+            self.failed = True
+
+unit_of_work = UnitOfWork()
+
+# dialects with INSERT ... ON CONFLICT DO UPDATE, see upsert_rows
+UPSERT_DIALECTS = {"postgresql": postgresql, "sqlite": sqlite}
+
+def upsert_rows(table, rows, key_columns):
+    """Insert rows (dicts of column values) into table, or update the
+    other columns of those whose key_columns already match a row. One
+    INSERT ... ON CONFLICT DO UPDATE on sqlite and postgresql; elsewhere an
+    UPDATE per row, then one INSERT of the rows that matched nothing.
+    Doesn't commit."""
+    if not rows:
+        return
+    dialect = UPSERT_DIALECTS.get(db.session.connection().dialect.name)
+    if dialect is not None:
+        insert = dialect.insert(table)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=[table.c[k] for k in key_columns],
+            set_=dict((c, insert.excluded[c]) for c in rows[0] if c not in key_columns)),
+            rows)
+        return
+    missing = []
+    for row in rows:
+        match = [table.c[k] == row[k] for k in key_columns]
+        values = dict((c, v) for c, v in row.items() if c not in key_columns)
+        if not db.session.execute(table.update().where(*match).values(values)).rowcount:
+            missing.append(row)
+    if missing:
+        db.session.execute(table.insert(), missing)
+
 class CRUDMixin(object):
     """Mixin that adds convenience methods for CRUD (create, read, update, delete)
     operations.
@@ -53,21 +140,21 @@ class CRUDMixin(object):
 
     def update(self, commit=True, **kwargs):
         """Update specific fields of a record."""
-        for attr, value in kwargs.iteritems():
+        for attr, value in kwargs.items():
             setattr(self, attr, value)
         return commit and self.save() or self
 
     def save(self, commit=True):
-        """Save the record."""
+        """Save the record. Inside unit_of_work this only flushes."""
         db.session.add(self)
         if commit:
-            db.session.commit()
+            unit_of_work.commit()
         return self
 
     def delete(self, commit=True):
         """Remove the record from the database."""
         db.session.delete(self)
-        return commit and db.session.commit()
+        return commit and unit_of_work.commit()
 
 class Model(CRUDMixin, db.Model, SurrogatePK):
     __abstract__ = True
@@ -89,10 +176,17 @@ class User(Model, UserMixin):
             self.password = None
 
     def set_password(self, password):
-        self.password = bcrypt.generate_password_hash(password)
+        self.password = passwords.hash_password(password)
 
     def check_password(self, value):
-        return bcrypt.check_password_hash(self.password, value)
+        """Check value against the stored hash, rehashing it at the
+        configured cost if it was made with an older one."""
+        if not passwords.check_password(self.password, value):
+            return False
+        if passwords.needs_rehash(self.password):
+            self.set_password(value)
+            db.session.commit()
+        return True
 
     @classmethod
     def get_admin_user(cls):
@@ -138,27 +232,66 @@ class User(Model, UserMixin):
 
 
 def make_url(title, body=''):
-    url = slugify(title or body[:140])
-    i = 1
-    while True:
-        if Post.query.filter(Post.url==url).count() == 0:
-            break
-        if i > 1000:
-            print("reached 1000 loops for post with title, body: %s" % (title, body))
-            raise
-        i += 1
-        url = url.split(".")[0] + "." + str(i)
-    return url
+    """Slug for a new post: the slugified title (or body) if it's free,
+    otherwise one past the highest numeric suffix in use. A single range
+    scan of the unique url index finds every "slug" and "slug.N"."""
+    base = slugify(title or body[:140])
+    # in byte order "/" sorts right after "." so this range is exactly the
+    # dotted urls. sqlite compares bytes already; a linguistic collation
+    # (PostgreSQL's default in most locales) skips punctuation at first and
+    # would put "slug.2" outside it. ix_posts_url_c serves this on PostgreSQL.
+    url = Post.url
+    if db.session.connection().dialect.name != "sqlite":
+        url = Post.url.collate("C")
+    taken = Post.query.with_entities(Post.url) \
+                      .filter((Post.url == base) |
+                              ((url >= base + ".") & (url < base + "/")))
+    used = False
+    highest = 1
+    for (url,) in taken:
+        suffix = url[len(base) + 1:]
+        if url == base:
+            used = True
+        elif suffix.isdigit():
+            highest = max(highest, int(suffix))
+    if not used:
+        return base
+    return "%s.%s" % (base, highest + 1)
+
+# longest stored excerpt, not counting the trailing ellipsis
+EXCERPT_LENGTH = 280
+
+def make_excerpt(body):
+    """The start of body with runs of whitespace collapsed, cut at a word
+    boundary to at most EXCERPT_LENGTH characters. A cut excerpt ends
+    with an ellipsis, so clients know there's more to fetch."""
+    text = " ".join((body or "").split())
+    if len(text) <= EXCERPT_LENGTH:
+        return text
+    cut = text[:EXCERPT_LENGTH + 1].rsplit(" ", 1)[0]
+    if len(cut) > EXCERPT_LENGTH or len(cut) < EXCERPT_LENGTH // 2:
+        cut = text[:EXCERPT_LENGTH]
+    return cut.rstrip() + u"\u2026"
 
 class Post(Model):
     __tablename__ = 'posts'
     title = db.Column(db.String(140))
     body = db.Column(db.Text)
+    # what listings show instead of the body, see make_excerpt
+    excerpt = db.Column(db.String(EXCERPT_LENGTH + 1), nullable=False, default='',
+                        server_default='')
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     user = db.relationship('User', backref=db.backref('posts', lazy='dynamic'))
     time_posted = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
     time_edited = db.Column(db.DateTime, nullable= True, default= None)
     url = db.Column(db.String(160), unique=True)
+    # kept current by Comment.submit_comment and Relation.link_posts so the
+    # action total is a single row read
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    link_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # bumped in the same transaction as every write that changes what the
+    # post's pages show; cached state and ETags are keyed on it
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def get_child_relations(self, limit=8, ids_only=False):
         if not ids_only:
@@ -183,11 +316,41 @@ class Post(Model):
     def __init__(self, title, body, user=None, user_id=None, time_posted=None):
         self.title = title
         self.body = body
+        self.excerpt = make_excerpt(body)
         if time_posted is None:
             time_posted = dt.datetime.utcnow()
         self.time_posted = time_posted
-        self.set_attr_or_id("user", user=user, user_id=user_id)
+        # before the user: linking it cascades the post into the session,
+        # and make_url's query would flush it without a url
         self.url = make_url(title, body)
+        self.set_attr_or_id("user", user=user, user_id=user_id)
+
+    @classmethod
+    def id_for_url(cls, url):
+        """The id of the post at url, or None if there's none; see
+        post_id_cache."""
+        post_id = post_id_cache.get(url)
+        if post_id is not None:
+            return post_id
+        if missing_url_cache.get(url):
+            return None
+        post_id = db.session.query(cls.id).filter(cls.url==url).scalar()
+        if post_id is None:
+            missing_url_cache.set(url, True)
+        else:
+            post_id_cache.set(url, post_id)
+        return post_id
+
+    @classmethod
+    def preload_url_cache(cls):
+        """Fill post_id_cache from one scan of the newest posts, up to its
+        size, inserting the newest last so they're evicted last. Returns
+        the number of urls loaded."""
+        rows = db.session.query(cls.url, cls.id).order_by(cls.id.desc()) \
+                         .limit(post_id_cache.maxsize).all()
+        for url, post_id in reversed(rows):
+            post_id_cache.set(url, post_id)
+        return len(rows)
 
     @classmethod
     def get_root_post(cls):
@@ -197,20 +360,88 @@ class Post(Model):
     def root_post_id(cls):
         return 1
 
+    @classmethod
+    def adjust_action_counts(cls, post_id, comments=0, links=0):
+        """Add to the stored comment/link counters without committing."""
+        cls.query.filter(cls.id==post_id) \
+                 .update({cls.comment_count: cls.comment_count + comments,
+                          cls.link_count: cls.link_count + links},
+                         synchronize_session=False)
+
+    @classmethod
+    def version_of(cls, post_id):
+        """The post's current version, or None if there's no such post."""
+        return db.session.query(cls.version).filter(cls.id==post_id).scalar()
+
+    @classmethod
+    def bump_versions(cls, *post_ids):
+        """Invalidate the cached state and ETags of the given posts, without
+        committing, so the bump lands with the write that made it."""
+        post_ids = set(post_id for post_id in post_ids if post_id is not None)
+        if post_ids:
+            cls.bump_versions_where(cls.id.in_(post_ids))
+
+    @classmethod
+    def bump_versions_where(cls, criterion):
+        """bump_versions for every post matching criterion."""
+        cls.query.filter(criterion) \
+                 .update({cls.version: cls.version + 1}, synchronize_session=False)
+
+    @classmethod
+    def rebuild_action_counts(cls):
+        """Recompute every post's comment and link counters.
+        Returns the number of posts that had drifted."""
+        comments = db.session.query(func.count(Comment.id)) \
+                             .filter(Comment.post_id==cls.id) \
+                             .correlate(cls).as_scalar()
+        links = db.session.query(func.count(Relation.id)) \
+                          .filter(Relation.parent_id==cls.id) \
+                          .correlate(cls).as_scalar()
+        fixed = cls.query.filter((cls.comment_count != comments) |
+                                 (cls.link_count != links)) \
+                         .update({cls.comment_count: comments,
+                                  cls.link_count: links,
+                                  cls.version: cls.version + 1},
+                                 synchronize_session=False)
+        db.session.commit()
+        return fixed
+
     @classmethod
     def submit_post(cls, user, text, title=None):
         if not (user and text):
             return "you need to include text to submit a post"
         if title and len(title) > 140:
             return "your title must be less than 140 characters long"
-        return cls.create(title=title, body=text, user=user)
+        # make_url can race another submit for the same slug; the unique
+        # index on url settles it and the loser picks the next suffix,
+        # rolling back only its own insert
+        with unit_of_work:
+            for attempt in range(3):
+                savepoint = db.session.begin_nested()
+                try:
+                    post = cls(title=title, body=text, user=user).save(commit=False)
+                    db.session.flush()
+                except IntegrityError:
+                    savepoint.rollback()
+                    if attempt == 2:
+                        raise
+                    continue
+                savepoint.commit()
+                search.index_post(post)
+                return post
 
     def edit_post(self, title, body):
         if (title and len(title) > 140):
             return "your title must be less than 140 characters long"
         self.title = title
         self.body = body
+        self.excerpt = make_excerpt(body)
         self.time_edited = dt.datetime.utcnow()
+        search.index_post(self)
+        # the parents list this post with its title and excerpt
+        Post.bump_versions_where((Post.id==self.id) |
+                                 Post.id.in_(db.session.query(Relation.parent_id)
+                                                       .filter(Relation.child_id==self.id)))
 
 
     @property
@@ -220,11 +451,42 @@ class Post(Model):
         ret_dict["time_posted"] = pytz.utc.localize(ret_dict["time_posted"])
         return ret_dict
 
+    @property
+    def listing_writeable(self):
+        """writeable with the excerpt in place of the body, for posts
+        shown in a list."""
+        ret_dict = self.writeable
+        del ret_dict["body"]
+        ret_dict["excerpt"] = self.excerpt
+        return ret_dict
+
     def __repr__(self):
         return '<Post %r>' % self.title
 
 
 
+# make_url's range in byte order; sqlite's url index already is
+db.event.listen(Post.__table__, "after_create",
+                DDL('CREATE INDEX ix_posts_url_c ON posts (url COLLATE "C")')
+                .execute_if(dialect="postgresql"))
+
+
+# how fast a link's hot_score decays with its age in hours
+HOT_GRAVITY = SETTINGS.get("HOT_GRAVITY", 1.8)
+
+def hotness(votecount, time_linked, now=None):
+    """Votes over age: (votes + 1) / (hours since linked + 2) ** HOT_GRAVITY.
+    The + 1 gives a new link some standing before anyone has voted."""
+    now = now or dt.datetime.utcnow()
+    hours = max((now - time_linked).total_seconds() / 3600.0, 0.0)
+    return (votecount + 1) / (hours + 2) ** HOT_GRAVITY
+
+
+# JobRun row moved by every Relation.rebuild_hot_scores; responses in hot
+# order carry it in their ETag (views.conditional_response)
+HOT_SCORES_EPOCH = "hot-scores-epoch"
+
+
 class Relation(Model):
     __tablename__ = 'relations'
     parent_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
@@ -236,7 +498,10 @@ class Relation(Model):
     linked_by_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     linked_by = db.relationship('User', backref=db.backref('links', lazy='dynamic'))
     time_linked = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
-
+    # running sum of Vote.value for this relation, kept current by Vote.submit_vote
+    votecount = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # hotness() as of the last vote or refresh, for the "hot" child sort
+    hot_score = db.Column(db.Float, nullable=False, default=0, server_default='0')
 
     def __init__(self, parent=None, parent_id=None, child=None, child_id=None, 
                  linked_by=None, linked_by_id=None, time_linked=None):
@@ -246,6 +511,7 @@ class Relation(Model):
         if time_linked is None:
             time_linked = dt.datetime.utcnow()
         self.time_linked = time_linked
+        self.hot_score = hotness(0, time_linked)
 
     @classmethod
     def link_posts(cls, parent, child, user):
@@ -256,17 +522,121 @@ class Relation(Model):
         kw = doc_or_doc_id("parent", parent, kw)
         kw = doc_or_doc_id("child", child, kw)
         kw = doc_or_doc_id("linked_by", user, kw)
-        return cls.create(**kw)
+        parent_id = parent if isinstance(parent, int) else parent.id
+        child_id = child if isinstance(child, int) else child.id
+        with unit_of_work:
+            # checked under the write lock, or two opposite links running
+            # at once could both pass and close a cycle
+            PostClosure.lock()
+            if PostClosure.would_cycle(parent_id, child_id):
+                return "linking these posts would create a cycle"
+            relation = cls(**kw).save(commit=False)
+            Post.adjust_action_counts(parent_id, links=1)
+            Post.bump_versions(parent_id)
+            PostClosure.add_edge(parent_id, child_id)
+            if events.watching(parent_id):
+                db.session.flush()
+                child_post = child if isinstance(child, Post) else Post.query.get(child_id)
+                events.publish(parent_id, "relation",
+                               {"rel": dict(relation.writeable, user_vote_value=0),
+                                "post": child_post.listing_writeable})
+        return relation
 
     def get_votes(self, limit=None):
         if limit is None:
             return Vote.query.filter(Vote.rel_id==self.id)
         return Vote.query.filter(Vote.rel_id==self.id).limit(limit)
 
-    @property
-    def votecount(self):
-        vote_sum = self.get_votes().with_entities(func.sum(Vote.value)).first()[0]
-        return int(vote_sum) if vote_sum is not None else 0
+    @classmethod
+    def adjust_votecount(cls, rel_id, delta):
+        """Add delta to the stored vote total without committing."""
+        cls.query.filter(cls.id==rel_id) \
+                 .update({cls.votecount: cls.votecount + delta},
+                         synchronize_session=False)
+
+    @classmethod
+    def recount_votes(cls, *rel_ids):
+        """Set the stored totals of the given relations from the votes
+        table, in one UPDATE and without committing."""
+        actual = db.session.query(func.coalesce(func.sum(Vote.value), 0)) \
+                           .filter(Vote.rel_id==cls.id) \
+                           .correlate(cls).as_scalar()
+        cls.query.filter(cls.id.in_(rel_ids)) \
+                 .update({cls.votecount: actual}, synchronize_session=False)
+
+    @classmethod
+    def bump_parent_versions(cls, *rel_ids):
+        """Post.bump_versions for the parents of the given relations."""
+        if rel_ids:
+            Post.bump_versions_where(Post.id.in_(
+                db.session.query(cls.parent_id).filter(cls.id.in_(rel_ids))))
+
+    @classmethod
+    def publish_votecounts(cls, *rel_ids):
+        """Queue a "votes" event with each relation's stored total for the
+        streams of the parent posts being watched."""
+        if not events.hub.channels:
+            return
+        rows = db.session.query(cls.id, cls.parent_id, cls.votecount) \
+                         .filter(cls.id.in_(rel_ids))
+        for rel_id, parent_id, votecount in rows:
+            events.publish(parent_id, "votes", {"rel_id": rel_id, "votecount": votecount})
+
+    @classmethod
+    def refresh_hot_scores(cls, *rel_ids):
+        """Recompute hot_score for the given relations without committing."""
+        now = dt.datetime.utcnow()
+        rows = db.session.query(cls.id, cls.votecount, cls.time_linked) \
+                         .filter(cls.id.in_(rel_ids)).all()
+        cls._write_hot_scores(rows, now)
+
+    @classmethod
+    def rebuild_hot_scores(cls, batch=10000):
+        """Recompute every hot_score, committing every batch relations so
+        writers aren't locked out for the whole pass. Post versions stay
+        put, since only the hot order changes; the hot scores epoch moves
+        instead, when the pass starts and when it ends. Returns the count."""
+        now = dt.datetime.utcnow()
+        last_id, count = 0, 0
+        JobRun.touch(HOT_SCORES_EPOCH)
+        while True:
+            rows = db.session.query(cls.id, cls.votecount, cls.time_linked) \
+                             .filter(cls.id > last_id).order_by(cls.id) \
+                             .limit(batch).all()
+            if not rows:
+                JobRun.touch(HOT_SCORES_EPOCH)
+                db.session.commit()
+                return count
+            cls._write_hot_scores(rows, now)
+            db.session.commit()
+            last_id = rows[-1][0]
+            count += len(rows)
+
+    @classmethod
+    def _write_hot_scores(cls, rows, now):
+        if not rows:
+            return
+        table = cls.__table__
+        db.session.execute(
+            table.update().where(table.c.id==bindparam("rel"))
+                          .values(hot_score=bindparam("score")),
+            [{"rel": rel_id, "score": hotness(votecount, time_linked, now)}
+             for rel_id, votecount, time_linked in rows])
+
+    @classmethod
+    def reconcile_votecounts(cls):
+        """Recompute every stored vote total from the votes table.
+        Returns the number of relations that had drifted."""
+        actual = db.session.query(func.coalesce(func.sum(Vote.value), 0)) \
+                           .filter(Vote.rel_id==cls.id) \
+                           .correlate(cls).as_scalar()
+        Post.bump_versions_where(Post.id.in_(
+            db.session.query(cls.parent_id).filter(cls.votecount != actual)))
+        fixed = cls.query.filter(cls.votecount != actual) \
+                         .update({cls.votecount: actual},
+                                 synchronize_session=False)
+        db.session.commit()
+        return fixed
 
     @property
     def writeable(self):
@@ -276,19 +646,148 @@ class Relation(Model):
         ret_dict["linked_by"] = ret_dict["linked_by"].writeable
         return ret_dict
 
-    def writeable_with_vote_info(self, user=None):
-        vote_value = 0
-        if user is None:
-            return dict(list(self.writeable.items()) + [("user_vote_value", vote_value)])
-        user_id = user if isinstance(user, int) else user.id
-        vote = Vote.query.filter((Vote.rel_id==self.id) & (Vote.user_id==user_id)).first()
-        if vote:
-            vote_value = int(vote.value)
-        return dict(list(self.writeable.items()) + [("user_vote_value", vote_value)])
-
     def __repr__(self):
         return '<Relation %r>' % self.id
 
+# serves child_rel_query(sort_by='hot') straight off the index
+db.Index('ix_relations_parent_hot', Relation.parent_id, Relation.hot_score.desc(),
+         Relation.id)
+# serves child_rel_query(sort_by='top') straight off the index
+db.Index('ix_relations_parent_votecount',
+         Relation.parent_id, Relation.votecount.desc(), Relation.id)
+# actions and the "new" child sort, both keyset paged on (time_linked, id)
+db.Index('ix_relations_parent_time', Relation.parent_id, Relation.time_linked,
+         Relation.id)
+# a post's parents (Post.get_parent_relations) and link lookups by child
+db.Index('ix_relations_child_parent', Relation.child_id, Relation.parent_id)
+
+class PostClosure(db.Model):
+    """Transitive closure of the Relation graph: one row per
+    (ancestor, descendant) pair with the length of the shortest path
+    between them. Relation.link_posts keeps it current and refuses links
+    that would close a cycle, so a post is never its own ancestor.
+    """
+    __tablename__ = 'post_closure'
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def ancestors(cls, post_id, max_depth=None, limit=None):
+        """Map ancestor id -> distance for post_id, nearest first."""
+        q = db.session.query(cls.ancestor_id, cls.depth) \
+                      .filter(cls.descendant_id==post_id)
+        if max_depth is not None:
+            q = q.filter(cls.depth <= max_depth)
+        return dict(q.order_by(cls.depth).limit(limit).all())
+
+    @classmethod
+    def descendants(cls, post_id, max_depth=None, limit=None):
+        """Map descendant id -> distance for post_id, nearest first."""
+        q = db.session.query(cls.descendant_id, cls.depth) \
+                      .filter(cls.ancestor_id==post_id)
+        if max_depth is not None:
+            q = q.filter(cls.depth <= max_depth)
+        return dict(q.order_by(cls.depth).limit(limit).all())
+
+    @classmethod
+    def lock(cls):
+        """Make other links wait until this transaction ends. On sqlite the
+        unit_of_work's write lock already does; PostgreSQL locks the
+        closure table against writers, which reads don't wait for."""
+        connection = db.session.connection()
+        if connection.dialect.name == "postgresql":
+            connection.exec_driver_sql(
+                "LOCK TABLE post_closure IN SHARE ROW EXCLUSIVE MODE")
+
+    @classmethod
+    def would_cycle(cls, parent_id, child_id):
+        """True if linking parent_id -> child_id would close a cycle."""
+        if parent_id == child_id:
+            return True
+        return db.session.query(cls.query.filter((cls.ancestor_id==child_id) &
+                                                 (cls.descendant_id==parent_id))
+                                         .exists()).scalar()
+
+    @classmethod
+    def add_edge(cls, parent_id, child_id):
+        """Record the paths created by a parent_id -> child_id link, without
+        committing. Callers lock() and check would_cycle first, in the
+        same transaction."""
+        ups = cls.ancestors(parent_id)
+        ups[parent_id] = 0
+        downs = cls.descendants(child_id)
+        downs[child_id] = 0
+        existing = dict(((a, d), depth) for a, d, depth in
+                        db.session.query(cls.ancestor_id, cls.descendant_id, cls.depth)
+                                  .filter(cls.ancestor_id.in_(list(ups)) &
+                                          cls.descendant_id.in_(list(downs))))
+        inserts, shorter = [], []
+        for a, up in ups.items():
+            for d, down in downs.items():
+                depth = up + 1 + down
+                current = existing.get((a, d))
+                row = {"a": a, "d": d, "depth": depth}
+                if current is None:
+                    inserts.append(row)
+                elif depth < current:
+                    shorter.append(row)
+        table = cls.__table__
+        if inserts:
+            db.session.execute(table.insert().values(
+                ancestor_id=bindparam("a"), descendant_id=bindparam("d"),
+                depth=bindparam("depth")), inserts)
+        if shorter:
+            db.session.execute(table.update()
+                               .where((table.c.ancestor_id==bindparam("a")) &
+                                      (table.c.descendant_id==bindparam("d")))
+                               .values(depth=bindparam("depth")), shorter)
+
+    @classmethod
+    def rebuild(cls, batch=10000):
+        """Recompute the whole closure from the relations table with a
+        breadth-first walk from every post, inserting batch rows at a time.
+        Edges that close a cycle (which link_posts refuses, but older data
+        may hold) are walked once and never make a post its own ancestor.
+        Returns the number of rows."""
+        children = {}
+        for parent_id, child_id in db.session.query(Relation.parent_id,
+                                                    Relation.child_id):
+            children.setdefault(parent_id, set()).add(child_id)
+        db.session.execute(cls.__table__.delete())
+        rows, count = [], 0
+        for root in children:
+            seen = {root: 0}
+            frontier = [root]
+            while frontier:
+                next_frontier = []
+                for post_id in frontier:
+                    for child_id in children.get(post_id, ()):
+                        if child_id not in seen:
+                            seen[child_id] = seen[post_id] + 1
+                            next_frontier.append(child_id)
+                frontier = next_frontier
+            rows.extend({"ancestor_id": root, "descendant_id": d, "depth": depth}
+                        for d, depth in seen.items() if d != root)
+            if len(rows) >= batch:
+                db.session.execute(cls.__table__.insert(), rows)
+                count += len(rows)
+                rows = []
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+            count += len(rows)
+        db.session.commit()
+        return count
+
+    def __repr__(self):
+        return '<PostClosure %r -> %r (%s)>' % (self.ancestor_id, self.descendant_id,
+                                                self.depth)
+
+db.Index('ix_post_closure_ancestor_depth', PostClosure.ancestor_id,
+         PostClosure.depth, PostClosure.descendant_id)
+db.Index('ix_post_closure_descendant_depth', PostClosure.descendant_id,
+         PostClosure.depth, PostClosure.ancestor_id)
+
 class Comment(Model):
     __tablename__ = 'comments'
     body = db.Column(db.Text)
@@ -315,7 +814,16 @@ class Comment(Model):
         kw = {"body": body}
         kw = doc_or_doc_id("user", user, kw)
         kw = doc_or_doc_id("post", post, kw)
-        return cls.create(**kw)
+        with unit_of_work:
+            comment = cls(**kw).save(commit=False)
+            post_id = post if isinstance(post, int) else post.id
+            Post.adjust_action_counts(post_id, comments=1)
+            Post.bump_versions(post_id)
+            db.session.flush()
+            search.index_comment(comment)
+            if events.watching(comment.post_id):
+                events.publish(comment.post_id, "comment", {"comment": comment.writeable})
+        return comment
 
     @property
     def writeable(self):
@@ -328,6 +836,9 @@ class Comment(Model):
     def __repr__(self):
         return '<Comment %r>' % self.body
 
+# keyset pagination of post actions, see db_queries.post_action_rows_by_cursor
+db.Index('ix_comments_post_time', Comment.post_id, Comment.time_posted, Comment.id)
+
 class Vote(CRUDMixin, db.Model):
     __tablename__ = 'votes'
     rel_id = db.Column(db.Integer, db.ForeignKey('relations.id'), primary_key=True)
@@ -336,6 +847,9 @@ class Vote(CRUDMixin, db.Model):
     user = db.relationship('User', backref=db.backref('votes', lazy='dynamic'))
     value = db.Column(db.Integer)
 
+    # the vote_buffer.VoteBuffer holding votes not yet written, if any
+    buffer = None
+
     def __init__(self, value=1, rel=None, rel_id=None, user=None, user_id=None):
         self.set_attr_or_id("rel", rel=rel, rel_id=rel_id)
         self.set_attr_or_id("user", user=user, user_id=user_id)
@@ -343,36 +857,178 @@ class Vote(CRUDMixin, db.Model):
 
     @classmethod
     def submit_vote(cls, user, rel, value=True):
+        """Vote on a relation, or take the vote back if the user already
+        voted that way. Returns the user's vote value afterwards (1, -1, or
+        0 for no vote). No rows are read first: which of a conditional
+        DELETE, an UPDATE and an INSERT on the (rel_id, user_id) key
+        matched says what the vote was before, and so what to add to the
+        relation's stored total."""
         if not (user and rel):
             return "missing data"
 
         user_id = user if isinstance(user, int) else user.id
         rel_id = rel if isinstance(rel, int) else rel.id
         value = 1 if value == 1 else -1
-        vote = cls.query.filter((Vote.user_id==user_id) & (Vote.rel_id==rel_id)).first()
-        if vote:
-            if vote.value == value:
-                return vote.delete()
-            return vote.update(value=value)
-        return cls.create(user_id=user_id, rel_id=rel_id, value=value)
+        table = cls.__table__
+        mine = (table.c.rel_id==rel_id) & (table.c.user_id==user_id)
+        with unit_of_work:
+            for attempt in range(3):
+                if db.session.execute(table.delete().where(mine & (table.c.value==value))).rowcount:
+                    delta, value = -value, 0
+                    break
+                # a vote that isn't this value is the opposite one
+                if db.session.execute(table.update().where(mine).values(value=value)).rowcount:
+                    delta = 2 * value
+                    break
+                # no vote yet; a concurrent first vote by the same user can
+                # take the key first, and then the loop sees its row
+                savepoint = db.session.begin_nested()
+                try:
+                    db.session.execute(table.insert().values(rel_id=rel_id, user_id=user_id,
+                                                             value=value))
+                except IntegrityError:
+                    savepoint.rollback()
+                    if attempt == 2:
+                        raise
+                    continue
+                savepoint.commit()
+                delta = value
+                break
+            Relation.adjust_votecount(rel_id, delta)
+            Relation.refresh_hot_scores(rel_id)
+            Relation.bump_parent_versions(rel_id)
+            Relation.publish_votecounts(rel_id)
+        return value
+
+    @classmethod
+    def user_vote_values(cls, user, rel_ids):
+        """Map rel_id -> the user's vote value for the given relations."""
+        if user is None or getattr(user, "is_anonymous", False) or not rel_ids:
+            return {}
+        user_id = user if isinstance(user, int) else user.id
+        votes = cls.query.with_entities(cls.rel_id, cls.value) \
+                         .filter((cls.user_id==user_id) & cls.rel_id.in_(rel_ids))
+        values = dict((rel_id, int(value)) for rel_id, value in votes)
+        if cls.buffer is not None:
+            values.update(cls.buffer.pending_values(user_id, rel_ids))
+        return values
 
     def __repr__(self):
         return '<Vote user:%r rel:%r value:%s>' % (self.user_id, self.rel_id, self.value)
 
 
+class JobRun(db.Model):
+    """When each periodic job last started. Workers claim a run through
+    this row, so a job runs once per interval across every process and
+    machine sharing the database; see jobs.PeriodicJob. A row can also
+    mark when something last happened, for readers that depend on it
+    (touch and last)."""
+    __tablename__ = 'job_runs'
+    name = db.Column(db.String(80), primary_key=True)
+    started_at = db.Column(db.DateTime, nullable=False)
+
+    @classmethod
+    def claim(cls, name, interval):
+        """True if the caller should run the job now: nobody started it in
+        the last interval seconds. The claim is committed before the job
+        runs."""
+        now = dt.datetime.utcnow()
+        table = cls.__table__
+        with unit_of_work:
+            due = (table.c.name==name) & \
+                (table.c.started_at <= now - dt.timedelta(seconds=interval))
+            if db.session.execute(table.update().where(due)
+                                              .values(started_at=now)).rowcount:
+                return True
+            # never run before, or run too recently: the insert says which
+            savepoint = db.session.begin_nested()
+            try:
+                db.session.execute(table.insert().values(name=name, started_at=now))
+            except IntegrityError:
+                savepoint.rollback()
+                return False
+            savepoint.commit()
+            return True
+
+    @classmethod
+    def touch(cls, name):
+        """Set name's time to now, without committing."""
+        upsert_rows(cls.__table__, [{"name": name, "started_at": dt.datetime.utcnow()}],
+                    ("name",))
+
+    @classmethod
+    def last(cls, name):
+        """name's time, or None if it never ran."""
+        return db.session.query(cls.started_at).filter(cls.name==name).scalar()
+
+    def __repr__(self):
+        return '<JobRun %r at %s>' % (self.name, self.started_at)
+
+# column values of recently seen users, so flask_login doesn't query the
+# users table on every request; see load_user
+user_cache = LRUCache(maxsize=SETTINGS.get("USER_CACHE_SIZE", 4096),
+                      ttl=SETTINGS.get("USER_CACHE_TTL", 300))
+
+@db.event.listens_for(User, "after_update")
+def invalidate_updated_user(mapper, connection, target):
+    # posting or voting through a user's backrefs also flushes it as an
+    # update, so only drop the entry if a column really changed
+    if db.object_session(target).is_modified(target, include_collections=False):
+        user_cache.delete(target.id)
+
+@db.event.listens_for(User, "after_delete")
+def invalidate_deleted_user(mapper, connection, target):
+    user_cache.delete(target.id)
+
+# post ids by url, for Post.id_for_url. A post keeps its url for good, so
+# a cached id never goes stale. Urls with no post are remembered for
+# URL_MISS_TTL seconds; creating a post forgets its url's miss in this
+# process, and other workers see the post once their miss expires.
+post_id_cache = LRUCache(maxsize=SETTINGS.get("URL_CACHE_SIZE", 65536))
+missing_url_cache = LRUCache(maxsize=SETTINGS.get("URL_MISS_CACHE_SIZE", 4096),
+                             ttl=SETTINGS.get("URL_MISS_TTL", 60))
+
+@db.event.listens_for(Post, "after_insert")
+def forget_missing_url(mapper, connection, target):
+    missing_url_cache.delete(target.url)
+
+@db.event.listens_for(Post, "after_delete")
+def forget_deleted_url(mapper, connection, target):
+    post_id_cache.delete(target.url)
+
 @login_manager.user_loader
 def load_user(userid):
-    return User.query.get(userid)
+    try:
+        userid = int(userid)
+    except ValueError:
+        return None
+    values = user_cache.get(userid)
+    if values is None:
+        user = User.query.get(userid)
+        if user is not None:
+            user_cache.set(userid, dict((attr.key, getattr(user, attr.key))
+                                        for attr in User.__mapper__.column_attrs))
+        return user
+    # rebuild the row as a clean persistent instance without a query
+    user = User.__mapper__.class_manager.new_instance()
+    for key, value in values.items():
+        set_committed_value(user, key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
 
 def setup_db(drop_tables_first=False):
     if drop_tables_first:
         db.drop_all()
+        search.drop_index()
     db.create_all()
+    search.create_index()
     # create admin user
     admin_user = User.create(username=SETTINGS["admin_username"],
                              password=SETTINGS["admin_password"],
                              email=SETTINGS["admin_email"])
     # create root post
-    Post.create(title="Welcome to Openthink!",
-                body="Browse these posts or submit your own!",
-                user=admin_user)
+    root = Post.create(title="Welcome to Openthink!",
+                       body="Browse these posts or submit your own!",
+                       user=admin_user)
+    search.index_post(root)
+    db.session.commit()
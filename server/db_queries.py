@@ -1,46 +1,253 @@
+from sqlalchemy import and_, case, or_, select, union_all
+import pytz
+
 from sqlalchemy.sql import func
 from sqlalchemy.sql.expression import literal_column
 from sqlalchemy.types import Unicode
 from db_models import *
+from utils import encode_cursor
+
+# Columns behind Post/Relation/Comment.writeable. The *_dicts functions
+# below read just these, with the user joined in, and build the writeable
+# dicts straight from the rows: no ORM objects, no identity map and no
+# lazy load per row.
+LISTING_POST_COLUMNS = (Post.id, Post.title, Post.excerpt, Post.user_id, Post.time_posted,
+                        Post.url)
+REL_COLUMNS = (Relation.id, Relation.parent_id, Relation.child_id, Relation.time_linked,
+               Relation.votecount, Relation.hot_score,
+               User.id.label("linker_id"), User.username.label("linker_name"))
+COMMENT_COLUMNS = (Comment.id, Comment.body, Comment.post_id, Comment.time_posted,
+                   User.id.label("commenter_id"), User.username.label("commenter_name"))
+
+def _user(user_id, username):
+    return None if user_id is None else {"username": username, "id": user_id}
+
+def listing_post_writeable(row):
+    return {"id": row.id, "title": row.title, "excerpt": row.excerpt,
+            "user_id": row.user_id, "time_posted": pytz.utc.localize(row.time_posted),
+            "url": row.url}
+
+def post_writeable(row):
+    ret_dict = listing_post_writeable(row)
+    del ret_dict["excerpt"]
+    ret_dict["body"] = row.body
+    return ret_dict
+
+def rel_writeable(row):
+    return {"id": row.id, "parent_id": row.parent_id, "child_id": row.child_id,
+            "linked_by": _user(row.linker_id, row.linker_name),
+            "time_linked": pytz.utc.localize(row.time_linked), "votecount": row.votecount}
+
+def comment_writeable(row):
+    return {"id": row.id, "body": row.body, "post_id": row.post_id,
+            "user": _user(row.commenter_id, row.commenter_name),
+            "time_posted": pytz.utc.localize(row.time_posted)}
+
+def _rel_rows():
+    return db.session.query(*REL_COLUMNS).outerjoin(User, User.id == Relation.linked_by_id)
+
+def listing_post_dicts(post_ids, with_body=()):
+    """Post.listing_writeable of each post in post_ids that exists, or the
+    full Post.writeable for those also in with_body. No other post's body
+    is read."""
+    if not post_ids:
+        return []
+    with_body = set(with_body)
+    columns = LISTING_POST_COLUMNS
+    if with_body:
+        columns += (case([(Post.id.in_(with_body), Post.body)]).label("body"),)
+    return [post_writeable(row) if row.id in with_body else listing_post_writeable(row)
+            for row in db.session.query(*columns).filter(Post.id.in_(post_ids))]
+
+def post_bodies(post_ids):
+    """Map post id -> full body for the posts in post_ids that exist."""
+    if not post_ids:
+        return {}
+    return dict(db.session.query(Post.id, Post.body).filter(Post.id.in_(post_ids)))
+
+def rel_dicts(rel_ids):
+    """Relation.writeable of each relation in rel_ids that exists."""
+    if not rel_ids:
+        return []
+    return [rel_writeable(row) for row in _rel_rows().filter(Relation.id.in_(rel_ids))]
+
+def rel_dicts_between(post_ids):
+    """Relation.writeable of every relation whose parent and child are
+    both in post_ids."""
+    return [rel_writeable(row) for row in
+            _rel_rows().filter(Relation.parent_id.in_(post_ids) &
+                               Relation.child_id.in_(post_ids))]
+
+def comment_dicts(comment_ids):
+    """Comment.writeable of each comment in comment_ids that exists."""
+    if not comment_ids:
+        return []
+    return [comment_writeable(row) for row in
+            db.session.query(*COMMENT_COLUMNS)
+                      .outerjoin(User, User.id == Comment.user_id)
+                      .filter(Comment.id.in_(comment_ids))]
+
+def with_vote_values(rels, user=None):
+    """Copies of the relation dicts with user's vote on each as
+    user_vote_value, read in one query."""
+    vote_values = Vote.user_vote_values(user, [rel["id"] for rel in rels])
+    return [dict(rel, user_vote_value=vote_values.get(rel["id"], 0)) for rel in rels]
 
 
-def child_rel_query(post_id, page=0, sort_by='top'):
+def _links_after(sort_by, cursor):
+    """Keyset condition for child links that sort after cursor."""
+    key, rel_id = cursor
+    if sort_by in ('top', 'hot'):
+        column = Relation.votecount if sort_by == 'top' else Relation.hot_score
+        return or_(column < key, and_(column == key, Relation.id > rel_id))
+    return or_(Relation.time_linked < key,
+               and_(Relation.time_linked == key, Relation.id < rel_id))
+
+def child_rel_query(post_id, page=0, sort_by='top', after=None):
+    """A page of child relations, by all-time votes ('top'), by votes
+    decayed with age ('hot') or newest first. `after` is a decoded links
+    cursor, which takes the place of `page` when given."""
+    return _child_rel_page(db.session.query(Relation), post_id, page, sort_by, after)
+
+def child_rel_rows(post_id, page=0, sort_by='top', after=None):
+    """child_rel_query as REL_COLUMNS rows, for rel_writeable and
+    links_cursor."""
+    return _child_rel_page(_rel_rows(), post_id, page, sort_by, after)
+
+def _child_rel_page(rels, post_id, page, sort_by, after):
+    rels = rels.filter(Relation.parent_id==post_id)
+    if after is not None:
+        rels = rels.filter(_links_after(sort_by, after))
     if sort_by == 'top':
-        counts = db.session.query(Vote.rel_id, func.sum(Vote.value)\
-                           .label('votecount'))\
-                           .group_by(Vote.rel_id).subquery()
-
-        rels_count = db.session.query(Relation, counts.c.votecount)\
-                               .filter(Relation.parent_id==post_id)\
-                               .outerjoin(counts, Relation.id==counts.c.rel_id)\
-                               .order_by(func.coalesce(counts.c.votecount, 0).desc(),
-                                         Relation.id)\
-                               .slice(page*8, (page+1) * 8)
-        rels = [rel_count[0] for rel_count in rels_count]
+        rels = rels.order_by(Relation.votecount.desc(), Relation.id)
+    elif sort_by == 'hot':
+        rels = rels.order_by(Relation.hot_score.desc(), Relation.id)
     else:
-        rels = db.session.query(Relation)\
-                         .order_by(Relation.time_linked.desc())\
-                         .filter(Relation.parent_id==post_id)\
-                         .slice(page*8, (page+1) * 8).all()
-    return rels
+        rels = rels.order_by(Relation.time_linked.desc(), Relation.id.desc())
+    if after is not None:
+        return rels.limit(8).all()
+    return rels.slice(page*8, (page+1) * 8).all()
+
+def links_cursor(rel, sort_by='top'):
+    key = {'top': rel.votecount, 'hot': rel.hot_score}.get(sort_by, rel.time_linked)
+    return encode_cursor([key, rel.id])
 
 def actions_query(post_id):
     dbq = db.session
-    comments = dbq.query(Comment.id, Comment.time_posted.label("time"),
+    comments = dbq.query(Comment.id.label("id"), Comment.time_posted.label("time"),
                          literal_column("'Comment'", Unicode).label("t"))\
                   .filter(Comment.post_id==post_id)
-    rels = dbq.query(Relation.id, Relation.time_linked.label("time"),
+    rels = dbq.query(Relation.id.label("id"), Relation.time_linked.label("time"),
                      literal_column("'Relation'", Unicode).label("t"))\
               .filter(Relation.parent_id==post_id)
     q = comments.union(rels)
     return q
 
-def post_actions(post_id, page=1):
+def _actions_arm(model, time_col, post_col, t, post_id, cursor, reverse):
+    """One side of the actions union, limited to a page past cursor so the
+    union never sees more than two pages of rows."""
+    q = select([model.id.label("id"), time_col.label("time"),
+                literal_column("'%s'" % t, Unicode).label("t")])\
+        .where(post_col==post_id)
+    if cursor is not None:
+        ctime, ctype, cid = cursor
+        past, past_or_equal = ((time_col < ctime, time_col <= ctime) if reverse
+                               else (time_col > ctime, time_col >= ctime))
+        if t == ctype:
+            past_id = model.id < cid if reverse else model.id > cid
+            q = q.where(or_(past, and_(time_col == ctime, past_id)))
+        elif (t < ctype) == reverse:
+            q = q.where(past_or_equal)
+        else:
+            q = q.where(past)
+    if reverse:
+        q = q.order_by(time_col.desc(), model.id.desc())
+    else:
+        q = q.order_by(time_col, model.id)
+    return select([q.limit(20).alias()])
+
+def post_action_rows(post_id, page=1):
     page = 1 if not page else page
-    actions = actions_query(post_id).order_by("time")\
-                                   .slice((page-1)*20, page*20).all()
+    return actions_query(post_id).order_by("time", "t", "id")\
+                                 .slice((page-1)*20, page*20).all()
+
+def post_action_rows_by_cursor(post_id, after=None, before=None):
+    """A page of (id, time, type) action rows strictly after `after` or
+    strictly before `before`, both decoded action cursors."""
+    reverse = after is None
+    cursor = before if reverse else after
+    union = union_all(
+        _actions_arm(Comment, Comment.time_posted, Comment.post_id, 'Comment',
+                     post_id, cursor, reverse),
+        _actions_arm(Relation, Relation.time_linked, Relation.parent_id, 'Relation',
+                     post_id, cursor, reverse)).alias("actions")
+    order = (union.c.time, union.c.t, union.c.id)
+    if reverse:
+        order = [col.desc() for col in order]
+    rows = db.session.query(union.c.id, union.c.time, union.c.t)\
+                     .order_by(*order).limit(20).all()
+    return rows[::-1] if reverse else rows
+
+def top_child_rel_ids(post_ids, per_post=8):
+    """The ids of the first page of "top" children of every post in
+    post_ids, from a single windowed query. Maps post id -> [rel id]."""
+    rank = func.row_number().over(partition_by=Relation.parent_id,
+                                  order_by=(Relation.votecount.desc(), Relation.id))
+    ranked = db.session.query(Relation.id.label("id"),
+                              Relation.parent_id.label("parent_id"),
+                              rank.label("rank"))\
+                       .filter(Relation.parent_id.in_(post_ids)).subquery()
+    ret = dict((post_id, []) for post_id in post_ids)
+    for rel_id, parent_id in db.session.query(ranked.c.id, ranked.c.parent_id)\
+                                       .filter(ranked.c.rank <= per_post)\
+                                       .order_by(ranked.c.parent_id, ranked.c.rank):
+        ret[parent_id].append(rel_id)
+    return ret
+
+def action_rows_for_pages(pages):
+    """Action rows for many (post_id, page) pairs from a single query over
+    all their comments and relations, numbered per post in the same order
+    post_action_rows pages them. Maps (post_id, page) -> [(id, time, type)]."""
+    pages = set((post_id, page or 1) for post_id, page in pages)
+    post_ids = set(post_id for post_id, _ in pages)
+    union = union_all(
+        select([Comment.id.label("id"), Comment.post_id.label("post_id"),
+                Comment.time_posted.label("time"),
+                literal_column("'Comment'", Unicode).label("t")])
+            .where(Comment.post_id.in_(post_ids)),
+        select([Relation.id.label("id"), Relation.parent_id.label("post_id"),
+                Relation.time_linked.label("time"),
+                literal_column("'Relation'", Unicode).label("t")])
+            .where(Relation.parent_id.in_(post_ids))).alias("actions")
+    n = func.row_number().over(partition_by=union.c.post_id,
+                               order_by=(union.c.time, union.c.t, union.c.id))
+    numbered = select([union.c.id, union.c.post_id, union.c.time, union.c.t,
+                       n.label("n")]).alias("numbered")
+    wanted = or_(*[and_(numbered.c.post_id == post_id,
+                        numbered.c.n > (page-1)*20, numbered.c.n <= page*20)
+                   for post_id, page in pages])
+    ret = dict((key, []) for key in pages)
+    for row in db.session.query(numbered).filter(wanted).order_by(numbered.c.n):
+        key = (row.post_id, (row.n - 1) // 20 + 1)
+        if key in ret:
+            ret[key].append((row.id, row.time, row.t))
+    return ret
+
+def action_counts(post_ids):
+    """Map post id -> total actions for many posts in one query."""
+    return dict((post_id, int(count)) for post_id, count in
+                db.session.query(Post.id, Post.comment_count + Post.link_count)\
+                          .filter(Post.id.in_(post_ids)))
+
+def action_cursor(row):
+    return encode_cursor([row[1], row[2], row[0]])
+
+def post_actions(post_id, page=1):
+    actions = post_action_rows(post_id, page=page)
     # should add the functionality to query the edits as well
     return [[action[0], action[2]] for action in actions]
 
 def total_actions(post_id):
-    return int(actions_query(post_id).count())
+    count = db.session.query(Post.comment_count + Post.link_count)\
+                      .filter(Post.id==post_id).scalar()
+    return int(count or 0)
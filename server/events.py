@@ -0,0 +1,155 @@
+"""
+Live post activity for /post/<id>/events (Server-Sent Events).
+
+Model write methods call publish() with a small delta: a new comment,
+a new link, or a relation's new vote total. The delta waits on the
+session and reaches subscribers only when the transaction commits. A
+rollback drops it.
+
+The hub fans events out to the subscribers of the same post in this
+process. Every subscriber has a bounded queue. A reader too slow to
+keep up loses its queue and gets a "reset" event telling it to
+re-fetch the post. Event ids increase through the process, and a
+reconnect with Last-Event-ID replays the recent events it missed, or
+gets a reset when they are no longer kept.
+
+A stream blocks in Subscriber.wait between events, so run the server
+with gevent workers (gunicorn -k gevent): every idle connection is
+then a sleeping greenlet rather than a thread. Events published by
+other worker processes don't reach this hub.
+"""
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import db
+from localsettings import SETTINGS
+
+QUEUE_SIZE = SETTINGS.get("EVENTS_QUEUE_SIZE", 100)
+REPLAY_SIZE = SETTINGS.get("EVENTS_REPLAY_SIZE", 100)
+MAX_SUBSCRIBERS = SETTINGS.get("EVENTS_MAX_SUBSCRIBERS", 10000)
+
+
+class Subscriber(object):
+
+    def __init__(self, post_id, seq):
+        self.post_id = post_id
+        self.seq = seq
+        self.queue = deque()
+        self.overflowed = False
+        self.ready = threading.Event()
+
+    def put(self, item):
+        self.seq = item[0]
+        if len(self.queue) >= QUEUE_SIZE:
+            self.queue.clear()
+            self.overflowed = True
+        else:
+            self.queue.append(item)
+        self.ready.set()
+
+    def wait(self, timeout):
+        """Block until something was published or timeout seconds pass.
+        Returns (events, overflowed, seq) and empties the queue; seq is
+        the id of the last event published to this subscriber."""
+        self.ready.wait(timeout)
+        with hub.lock:
+            self.ready.clear()
+            items, self.queue = list(self.queue), deque()
+            overflowed, self.overflowed = self.overflowed, False
+            return items, overflowed, self.seq
+
+
+class Channel(object):
+    """The subscribers of one post and the events they may need to replay.
+    Every event from seq onwards is either in recent or was never sent."""
+
+    def __init__(self, seq):
+        self.subscribers = set()
+        self.seq = seq
+        self.recent = deque(maxlen=REPLAY_SIZE)
+
+
+class Hub(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.count = 0
+        # event ids increase across restarts, so an id from before one
+        # can't be taken for a recent event
+        self.seq = int(time.time() * 1000)
+
+    def subscribe(self, post_id, last_seq=None):
+        """A new Subscriber for post_id, or None when this process already
+        holds MAX_SUBSCRIBERS streams. With last_seq, the events after it
+        are queued for replay; if they're gone it starts overflowed,
+        which the stream turns into a reset."""
+        with self.lock:
+            if self.count >= MAX_SUBSCRIBERS:
+                return None
+            channel = self.channels.get(post_id)
+            if channel is None:
+                channel = self.channels[post_id] = Channel(self.seq)
+            subscriber = Subscriber(post_id, self.seq)
+            if last_seq is not None and last_seq != self.seq:
+                oldest = channel.seq
+                if len(channel.recent) == channel.recent.maxlen:
+                    oldest = channel.recent[0][0]
+                if last_seq < oldest or last_seq > self.seq:
+                    subscriber.overflowed = True
+                    subscriber.ready.set()
+                else:
+                    for item in channel.recent:
+                        if item[0] > last_seq:
+                            subscriber.put(item)
+                    subscriber.seq = self.seq
+            channel.subscribers.add(subscriber)
+            self.count += 1
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            channel = self.channels.get(subscriber.post_id)
+            if channel is None or subscriber not in channel.subscribers:
+                return
+            channel.subscribers.discard(subscriber)
+            self.count -= 1
+            if not channel.subscribers:
+                del self.channels[subscriber.post_id]
+
+    def publish(self, post_id, kind, data):
+        with self.lock:
+            channel = self.channels.get(post_id)
+            if channel is None:
+                return
+            self.seq += 1
+            item = (self.seq, kind, data)
+            channel.recent.append(item)
+            for subscriber in channel.subscribers:
+                subscriber.put(item)
+
+hub = Hub()
+
+def watching(post_id):
+    """Whether anyone in this process is subscribed to post_id, so
+    writers can skip building events nobody will read."""
+    return post_id in hub.channels
+
+def publish(post_id, kind, data):
+    """Send (kind, data) to post_id's subscribers once the current
+    transaction commits."""
+    if watching(post_id):
+        db.session.info.setdefault("post_events", []).append((post_id, kind, data))
+
+@event.listens_for(Session, "after_commit")
+def deliver_events(session):
+    for post_id, kind, data in session.info.pop("post_events", ()):
+        hub.publish(post_id, kind, data)
+
+@event.listens_for(Session, "after_rollback")
+def drop_events(session):
+    session.info.pop("post_events", None)
@@ -0,0 +1,61 @@
+"""
+Periodic jobs run on daemon threads inside the web process.
+
+A job's thread starts with the first request its process serves, so
+workers forked after import each get their own. Every interval each
+thread tries to claim the job's JobRun row, and only the one that gets
+it runs the job, so it runs once per interval however many workers and
+machines share the database. Set the interval to 0 to leave a job to
+the matching manage.py command and cron instead.
+"""
+import logging
+import os
+import threading
+
+from app import app
+from db_models import JobRun, Relation
+from localsettings import SETTINGS
+
+log = logging.getLogger("openthink.jobs")
+
+
+class PeriodicJob(object):
+
+    def __init__(self, app, name, interval, fn):
+        self.app = app
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        if not self.interval or (self._thread is not None and self._pid == os.getpid()):
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        wait = threading.Event().wait
+        while True:
+            wait(self.interval)
+            try:
+                with self.app.app_context():
+                    if JobRun.claim(self.name, self.interval):
+                        self.fn()
+            except Exception:
+                log.exception("periodic job %s failed", self.name)
+
+
+hot_scores = PeriodicJob(app, "hot-scores", SETTINGS.get("HOT_SCORE_REFRESH_SECONDS", 600),
+                         Relation.rebuild_hot_scores)
+
+@app.before_request
+def start_jobs():
+    hot_scores.start()
@@ -7,6 +7,28 @@ SETTINGS = {
     'DB_CONNECTION_STRING' :
         r"sqlite:///C:\Users\yeshw\Desktop\OpenThink\server\temp.db"
     ,
+    # replica that GET requests read from; None sends everything to the primary
+    'DB_READ_CONNECTION_STRING' :
+        None
+    ,
+    # pool sizing, ignored for sqlite
+    'DB_POOL_SIZE' :
+        10
+    ,
+    'DB_MAX_OVERFLOW' :
+        20
+    ,
+    'DB_POOL_RECYCLE' :
+        1800
+    ,
+    'DB_POOL_PRE_PING' :
+        True
+    ,
+    # applied to every new sqlite connection
+    'SQLITE_PRAGMAS' :
+        {"journal_mode": "WAL", "synchronous": "NORMAL", "busy_timeout": 5000,
+         "mmap_size": 268435456, "cache_size": -65536, "temp_store": "MEMORY"}
+    ,
     'admin_username' :
         "yesh"
     ,
@@ -16,6 +38,102 @@ SETTINGS = {
     'admin_email':
         "yeshwanthb@rocketmail.com"
     ,
+    # "lru" (per process), "sqlite" (shared by workers on one box) or "none";
+    # entries are keyed on the version stored on each post, so any of them
+    # stays correct with many workers, and "sqlite" gives them one cache
+    'CACHE_BACKEND' :
+        "lru"
+    ,
+    'CACHE_PATH' :
+        None
+    ,
+    # entries kept; both backends drop the least recently used beyond it
+    'CACHE_SIZE' :
+        1024
+    ,
+    # bcrypt cost; older hashes are upgraded on the next successful login
+    'BCRYPT_LOG_ROUNDS' :
+        12
+    ,
+    # processes hashing passwords (0 hashes on the request thread)
+    'PASSWORD_WORKERS' :
+        2
+    ,
+    # password jobs queued or running at once; past that logins get a 503
+    'PASSWORD_QUEUE_DEPTH' :
+        16
+    ,
+    # seconds a request waits for its password job before answering 503
+    'PASSWORD_TIMEOUT' :
+        10
+    ,
+    # logged-in users kept in memory between requests, and for how long
+    'USER_CACHE_SIZE' :
+        4096
+    ,
+    'USER_CACHE_TTL' :
+        300
+    ,
+    # per-request timing and SQL counts on /metrics, and the threshold
+    # above which a statement is logged on the "openthink.sql" logger
+    'METRICS_ENABLED' :
+        True
+    ,
+    'SLOW_QUERY_MS' :
+        100
+    ,
+    # the "hot" child sort: how fast links decay with age, and how often
+    # every score is recomputed, by whichever worker claims the run first
+    # (0 leaves it to the refresh_hot_scores command)
+    'HOT_GRAVITY' :
+        1.8
+    ,
+    'HOT_SCORE_REFRESH_SECONDS' :
+        600
+    ,
+    # write votes behind, in batches, instead of on the request
+    'VOTE_BUFFER_ENABLED' :
+        False
+    ,
+    'VOTE_BUFFER_INTERVAL_MS' :
+        200
+    ,
+    'VOTE_BUFFER_MAX_PENDING' :
+        5000
+    ,
+    # /post/<id>/events: per-connection queue length, events kept per
+    # post for reconnects, streams allowed per process, heartbeat interval
+    'EVENTS_QUEUE_SIZE' :
+        100
+    ,
+    'EVENTS_REPLAY_SIZE' :
+        100
+    ,
+    'EVENTS_MAX_SUBSCRIBERS' :
+        10000
+    ,
+    'EVENTS_HEARTBEAT_SECONDS' :
+        15
+    ,
+    # post ids by url for /post/<url> and link-post: how many to keep, how
+    # long a url with no post is remembered, and whether each worker
+    # loads the newest urls on its first request
+    'URL_CACHE_SIZE' :
+        65536
+    ,
+    'URL_MISS_CACHE_SIZE' :
+        4096
+    ,
+    'URL_MISS_TTL' :
+        60
+    ,
+    'URL_CACHE_PRELOAD' :
+        False
+    ,
+    # pasted link texts whose route match is remembered
+    'LINK_TEXT_CACHE_SIZE' :
+        4096
+    ,
 }
 
 
@@ -8,8 +8,11 @@ then when you want to run your app, you point to main.py or `main.app`
 from app import app, db
 from db_models import *
 from views import *
+import metrics
+import jobs
 
 app.register_blueprint(blueprint)
+app.register_blueprint(metrics.blueprint)
 
 if __name__ == '__main__':
     # create_tables()
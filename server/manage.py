@@ -1,5 +1,71 @@
+import sys
 from app import manager
 from db_models import *
+import search
+import bulk
+import query_plans
+
+@manager.command
+def reconcile_votecounts():
+    "Repair stored relation vote totals that drifted from the votes table"
+    fixed = Relation.reconcile_votecounts()
+    print("reconciled %s relations" % fixed)
+
+@manager.command
+def rebuild_action_counts():
+    "Recompute the per-post comment and link counters"
+    fixed = Post.rebuild_action_counts()
+    print("rebuilt counters on %s posts" % fixed)
+
+@manager.command
+def refresh_hot_scores():
+    "Recompute every relation's hot_score for the 'hot' child sort"
+    count = Relation.rebuild_hot_scores()
+    print("refreshed %s relations" % count)
+
+@manager.command
+def rebuild_closure():
+    "Recompute the post ancestor/descendant closure table from relations"
+    rows = PostClosure.rebuild()
+    print("closure rebuilt with %s rows" % rows)
+
+@manager.command
+def rebuild_search_index():
+    "Reindex every post and comment for full-text search"
+    entries = search.rebuild_index()
+    print("search index rebuilt with %s entries" % entries)
+
+@manager.command
+def check_query_plans(verbose=False):
+    "Explain the per-request queries and fail if any scans a whole table"
+    failures = query_plans.check_query_plans(verbose=verbose, out=sys.stdout)
+    if failures:
+        print("%s queries scan a whole table: %s" % (len(failures), ", ".join(failures)))
+        sys.exit(1)
+    print("no full table scans")
+
+@manager.command
+def export_data(path="-"):
+    "Stream users, posts, relations, comments and votes out as NDJSON"
+    out = sys.stdout if path == "-" else open(path, "w")
+    try:
+        rows = bulk.export_ndjson(out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write("exported %s rows\n" % rows)
+
+@manager.command
+def import_data(path="-", batch=10000):
+    "Bulk import an NDJSON export, remapping ids and slugs"
+    lines = sys.stdin if path == "-" else open(path)
+    try:
+        counts = bulk.import_ndjson(lines, batch=int(batch))
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    print(", ".join("%s %ss" % (counts[kind], kind) for kind, _, _ in
+                    bulk.EXPORT_COLUMNS))
 
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,202 @@
+"""
+Per-request timing and SQL instrumentation, served as Prometheus text.
+
+Every request records its wall time, how many SQL statements it ran and
+how long they took, under the Flask endpoint that served it. Statements
+slower than SETTINGS["SLOW_QUERY_MS"] are logged on the "openthink.sql"
+logger with their parameters. GET /metrics renders the histograms and
+counters, plus hit and miss counts for the state, user and url caches.
+
+The numbers live in this process, so with several workers each scrape
+sees the worker that answered it; Prometheus sums them across instances
+as usual. Recording a request is a few additions under a lock, cheap
+enough to leave on.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from flask import Blueprint, Response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cache import cache
+from db_models import user_cache, post_id_cache, missing_url_cache
+from localsettings import SETTINGS
+
+blueprint = Blueprint('metrics', __name__)
+log = logging.getLogger("openthink.sql")
+
+ENABLED = SETTINGS.get("METRICS_ENABLED", True)
+SLOW_QUERY_MS = SETTINGS.get("SLOW_QUERY_MS", 100)
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _labels(labels):
+    return ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                    for k, v in labels)
+
+def _sample(name, labels, value):
+    if labels:
+        return "%s{%s} %s" % (name, labels, value)
+    return "%s %s" % (name, value)
+
+
+class Counter(object):
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s counter" % self.name]
+        with self._lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(_sample(self.name, _labels(labels), value))
+        return lines
+
+
+class Histogram(object):
+    """Observations counted into fixed buckets per label set."""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                # one count per bucket plus +Inf, then the sum
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s histogram" % self.name]
+        with self._lock:
+            series = sorted((labels, list(counts)) for labels, counts in self.series.items())
+        for labels, counts in series:
+            total = 0
+            prefix = _labels(labels) + "," if labels else ""
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                lines.append('%s_bucket{%sle="%s"} %d' % (self.name, prefix, bound, total))
+            lines.append(_sample(self.name + "_sum", _labels(labels), counts[-1]))
+            lines.append(_sample(self.name + "_count", _labels(labels), total))
+        return lines
+
+
+request_seconds = Histogram("openthink_request_seconds",
+                            "Wall time of requests by endpoint.", SECONDS_BUCKETS)
+request_statements = Histogram("openthink_request_sql_statements",
+                               "SQL statements run per request by endpoint.",
+                               STATEMENT_BUCKETS)
+request_sql_seconds = Histogram("openthink_request_sql_seconds",
+                                "Time spent in SQL per request by endpoint.",
+                                SECONDS_BUCKETS)
+requests_total = Counter("openthink_requests_total",
+                         "Requests by endpoint and status code.")
+slow_queries_total = Counter("openthink_slow_queries_total",
+                             "Statements slower than SLOW_QUERY_MS.")
+
+
+class RequestStats(threading.local):
+    """The running totals of the request on this thread, if any."""
+    active = False
+    start = 0.0
+    statements = 0
+    sql_seconds = 0.0
+
+current = RequestStats()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append((cursor, time.perf_counter()))
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # a statement that raised never reaches after_cursor_execute; only
+    # pop if it got as far as before_cursor_execute
+    cursor = context.cursor or getattr(context.execution_context, "cursor", None)
+    if context.connection is None or cursor is None:
+        return
+    started = context.connection.info.get("metrics_started")
+    if started and started[-1][0] is cursor:
+        started.pop()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_started"].pop()[1]
+    if current.active:
+        current.statements += 1
+        current.sql_seconds += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_queries_total.inc()
+        log.warning("slow query (%.1f ms): %s %.1000r", elapsed * 1000,
+                    statement, parameters)
+
+@blueprint.before_app_request
+def start_request():
+    if ENABLED:
+        current.active = True
+        current.start = time.perf_counter()
+        current.statements = 0
+        current.sql_seconds = 0.0
+
+def record_request(status):
+    if not current.active:
+        return
+    current.active = False
+    labels = (("endpoint", request.endpoint or "unmatched"),)
+    request_seconds.observe(labels, time.perf_counter() - current.start)
+    request_statements.observe(labels, current.statements)
+    request_sql_seconds.observe(labels, current.sql_seconds)
+    requests_total.inc(labels + (("status", status),))
+
+@blueprint.after_app_request
+def finish_request(response):
+    record_request(response.status_code)
+    return response
+
+@blueprint.teardown_app_request
+def abort_request(exc):
+    # only still active when the view raised before a response was made
+    record_request(500)
+
+def cache_lines():
+    name = "openthink_cache_lookups_total"
+    lines = ["# HELP %s Cache lookups by cache and result." % name,
+             "# TYPE %s counter" % name]
+    for label, backend in (("state", cache), ("user", user_cache), ("url", post_id_cache),
+                           ("missing_url", missing_url_cache)):
+        for attr, result in (("hits", "hit"), ("misses", "miss")):
+            value = getattr(backend, attr, None)
+            if value is not None:
+                lines.append('%s{cache="%s",result="%s"} %d' % (name, label, result, value))
+    return lines
+
+@blueprint.route('/metrics')
+def metrics_endpoint():
+    lines = []
+    for metric in (request_seconds, request_statements, request_sql_seconds,
+                   requests_total, slow_queries_total):
+        lines.extend(metric.render())
+    lines.extend(cache_lines())
+    return Response("\n".join(lines) + "\n",
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
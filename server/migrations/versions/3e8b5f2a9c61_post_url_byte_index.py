@@ -0,0 +1,24 @@
+"""index post urls in byte order on PostgreSQL for make_url
+
+Revision ID: 3e8b5f2a9c61
+Revises: 7a2c6e9d4f18
+Create Date: 2026-10-18 22:14:37.208415
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e8b5f2a9c61'
+down_revision = '7a2c6e9d4f18'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE INDEX ix_posts_url_c ON posts (url COLLATE "C")')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_posts_url_c', 'posts')
@@ -0,0 +1,30 @@
+"""store vote totals on relations
+
+Revision ID: 3f6c2a9d81b4
+Revises: 56932a434d0a
+Create Date: 2026-10-18 09:12:41.520318
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f6c2a9d81b4'
+down_revision = '56932a434d0a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('relations', sa.Column('votecount', sa.Integer(), nullable=False,
+                                         server_default='0'))
+    op.execute("UPDATE relations SET votecount = "
+               "(SELECT COALESCE(SUM(votes.value), 0) FROM votes "
+               "WHERE votes.rel_id = relations.id)")
+    op.create_index('ix_relations_parent_votecount', 'relations',
+                    ['parent_id', sa.text('votecount DESC'), 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_relations_parent_votecount', 'relations')
+    with op.batch_alter_table('relations') as batch_op:
+        batch_op.drop_column('votecount')
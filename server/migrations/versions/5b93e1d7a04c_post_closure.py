@@ -0,0 +1,73 @@
+"""post ancestor/descendant closure table
+
+Revision ID: 5b93e1d7a04c
+Revises: c27e5b0f93d6
+Create Date: 2026-10-18 14:41:09.335817
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b93e1d7a04c'
+down_revision = 'c27e5b0f93d6'
+
+from alembic import op
+import sqlalchemy as sa
+
+BATCH = 10000
+
+
+def upgrade():
+    op.create_table('post_closure',
+        sa.Column('ancestor_id', sa.Integer(), nullable=False),
+        sa.Column('descendant_id', sa.Integer(), nullable=False),
+        sa.Column('depth', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['ancestor_id'], ['posts.id']),
+        sa.ForeignKeyConstraint(['descendant_id'], ['posts.id']),
+        sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id')
+    )
+    op.create_index('ix_post_closure_ancestor_depth', 'post_closure',
+                    ['ancestor_id', 'depth', 'descendant_id'])
+    op.create_index('ix_post_closure_descendant_depth', 'post_closure',
+                    ['descendant_id', 'depth', 'ancestor_id'])
+    backfill()
+
+
+def backfill():
+    """PostClosure.rebuild when this was written: a breadth-first walk
+    from every post over the existing relations, keeping the shortest
+    depth and never making a post its own ancestor."""
+    bind = op.get_bind()
+    relations = sa.table('relations', sa.column('parent_id', sa.Integer),
+                         sa.column('child_id', sa.Integer))
+    closure = sa.table('post_closure', sa.column('ancestor_id', sa.Integer),
+                       sa.column('descendant_id', sa.Integer),
+                       sa.column('depth', sa.Integer))
+    children = {}
+    for parent_id, child_id in bind.execute(
+            sa.select([relations.c.parent_id, relations.c.child_id])):
+        children.setdefault(parent_id, set()).add(child_id)
+    rows = []
+    for root in children:
+        seen = {root: 0}
+        frontier = [root]
+        while frontier:
+            next_frontier = []
+            for post_id in frontier:
+                for child_id in children.get(post_id, ()):
+                    if child_id not in seen:
+                        seen[child_id] = seen[post_id] + 1
+                        next_frontier.append(child_id)
+            frontier = next_frontier
+        rows.extend({"ancestor_id": root, "descendant_id": d, "depth": depth}
+                    for d, depth in seen.items() if d != root)
+        if len(rows) >= BATCH:
+            bind.execute(closure.insert(), rows)
+            rows = []
+    if rows:
+        bind.execute(closure.insert(), rows)
+
+
+def downgrade():
+    op.drop_index('ix_post_closure_descendant_depth', 'post_closure')
+    op.drop_index('ix_post_closure_ancestor_depth', 'post_closure')
+    op.drop_table('post_closure')
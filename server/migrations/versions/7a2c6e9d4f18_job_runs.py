@@ -0,0 +1,26 @@
+"""last start of each periodic job, so one worker runs it per interval
+
+Revision ID: 7a2c6e9d4f18
+Revises: d5e8a1f36c90
+Create Date: 2026-10-18 21:03:16.552981
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a2c6e9d4f18'
+down_revision = 'd5e8a1f36c90'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('job_runs',
+        sa.Column('name', sa.String(length=80), nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('job_runs')
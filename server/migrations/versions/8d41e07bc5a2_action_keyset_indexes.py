@@ -0,0 +1,26 @@
+"""indexes for keyset paging of actions and links
+
+Revision ID: 8d41e07bc5a2
+Revises: 3f6c2a9d81b4
+Create Date: 2026-10-18 11:03:27.904116
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d41e07bc5a2'
+down_revision = '3f6c2a9d81b4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_comments_post_time', 'comments',
+                    ['post_id', 'time_posted', 'id'])
+    op.create_index('ix_relations_parent_time', 'relations',
+                    ['parent_id', 'time_linked', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_relations_parent_time', 'relations')
+    op.drop_index('ix_comments_post_time', 'comments')
@@ -0,0 +1,56 @@
+"""store a time-decayed hot score on relations
+
+Revision ID: a4d9c3e1f7b2
+Revises: e6a0f4c2b719
+Create Date: 2026-10-18 16:02:37.884120
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4d9c3e1f7b2'
+down_revision = 'e6a0f4c2b719'
+
+import datetime as dt
+
+from alembic import op
+import sqlalchemy as sa
+
+# db_models.HOT_GRAVITY when this was written; refresh_hot_scores
+# recomputes everything with the current setting
+GRAVITY = 1.8
+BATCH = 10000
+
+
+def upgrade():
+    op.add_column('relations', sa.Column('hot_score', sa.Float(), nullable=False,
+                                         server_default='0'))
+    relations = sa.table('relations', sa.column('id', sa.Integer),
+                         sa.column('votecount', sa.Integer),
+                         sa.column('time_linked', sa.DateTime),
+                         sa.column('hot_score', sa.Float))
+    update = relations.update().where(relations.c.id == sa.bindparam('rel')) \
+                               .values(hot_score=sa.bindparam('score'))
+    bind = op.get_bind()
+    now = dt.datetime.utcnow()
+    last_id = 0
+    while True:
+        rows = bind.execute(sa.select([relations.c.id, relations.c.votecount,
+                                       relations.c.time_linked])
+                            .where(relations.c.id > last_id)
+                            .order_by(relations.c.id).limit(BATCH)).fetchall()
+        if not rows:
+            break
+        bind.execute(update, [
+            {"rel": rel_id,
+             "score": (votecount + 1) / (max((now - time_linked).total_seconds(), 0)
+                                         / 3600.0 + 2) ** GRAVITY}
+            for rel_id, votecount, time_linked in rows])
+        last_id = rows[-1][0]
+    op.create_index('ix_relations_parent_hot', 'relations',
+                    ['parent_id', sa.text('hot_score DESC'), 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_relations_parent_hot', 'relations')
+    with op.batch_alter_table('relations') as batch_op:
+        batch_op.drop_column('hot_score')
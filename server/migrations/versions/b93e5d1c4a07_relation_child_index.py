@@ -0,0 +1,22 @@
+"""index relations by child for parent lookups
+
+Revision ID: b93e5d1c4a07
+Revises: f1c7a2b8d053
+Create Date: 2026-10-18 18:40:52.604517
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b93e5d1c4a07'
+down_revision = 'f1c7a2b8d053'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_relations_child_parent', 'relations', ['child_id', 'parent_id'])
+
+
+def downgrade():
+    op.drop_index('ix_relations_child_parent', 'relations')
@@ -0,0 +1,32 @@
+"""per-post comment and link counters
+
+Revision ID: c27e5b0f93d6
+Revises: 8d41e07bc5a2
+Create Date: 2026-10-18 12:20:54.117640
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c27e5b0f93d6'
+down_revision = '8d41e07bc5a2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('comment_count', sa.Integer(), nullable=False,
+                                     server_default='0'))
+    op.add_column('posts', sa.Column('link_count', sa.Integer(), nullable=False,
+                                     server_default='0'))
+    op.execute("UPDATE posts SET "
+               "comment_count = (SELECT COUNT(*) FROM comments "
+               "WHERE comments.post_id = posts.id), "
+               "link_count = (SELECT COUNT(*) FROM relations "
+               "WHERE relations.parent_id = posts.id)")
+
+
+def downgrade():
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('link_count')
+        batch_op.drop_column('comment_count')
@@ -0,0 +1,24 @@
+"""per-post version for cached state and ETags
+
+Revision ID: d5e8a1f36c90
+Revises: b93e5d1c4a07
+Create Date: 2026-10-18 20:12:37.418093
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd5e8a1f36c90'
+down_revision = 'b93e5d1c4a07'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('version', sa.Integer(), nullable=False,
+                                     server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('version')
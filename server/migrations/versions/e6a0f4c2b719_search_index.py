@@ -0,0 +1,34 @@
+"""full-text search index (sqlite only)
+
+Revision ID: e6a0f4c2b719
+Revises: 5b93e1d7a04c
+Create Date: 2026-10-18 15:37:52.802664
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e6a0f4c2b719'
+down_revision = '5b93e1d7a04c'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                   "title, body, kind UNINDEXED, ref_id UNINDEXED, "
+                   "post_id UNINDEXED, prefix='2 3')")
+        # search.rebuild_index when this was written
+        op.execute("INSERT INTO search_index (rowid, title, body, kind, ref_id, post_id) "
+                   "SELECT id * 2, COALESCE(title, ''), COALESCE(body, ''), 'post', id, id "
+                   "FROM posts")
+        op.execute("INSERT INTO search_index (rowid, title, body, kind, ref_id, post_id) "
+                   "SELECT id * 2 + 1, '', COALESCE(body, ''), 'comment', id, post_id "
+                   "FROM comments")
+        op.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute("DROP TABLE IF EXISTS search_index")
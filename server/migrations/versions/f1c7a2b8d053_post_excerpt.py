@@ -0,0 +1,53 @@
+"""store a short excerpt of each post for listings
+
+Revision ID: f1c7a2b8d053
+Revises: a4d9c3e1f7b2
+Create Date: 2026-10-18 17:25:09.311842
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f1c7a2b8d053'
+down_revision = 'a4d9c3e1f7b2'
+
+from alembic import op
+import sqlalchemy as sa
+
+# db_models.EXCERPT_LENGTH and make_excerpt when this was written
+EXCERPT_LENGTH = 280
+BATCH = 10000
+
+
+def make_excerpt(body):
+    text = " ".join((body or "").split())
+    if len(text) <= EXCERPT_LENGTH:
+        return text
+    cut = text[:EXCERPT_LENGTH + 1].rsplit(" ", 1)[0]
+    if len(cut) > EXCERPT_LENGTH or len(cut) < EXCERPT_LENGTH // 2:
+        cut = text[:EXCERPT_LENGTH]
+    return cut.rstrip() + u"\u2026"
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('excerpt', sa.String(length=EXCERPT_LENGTH + 1),
+                                     nullable=False, server_default=''))
+    posts = sa.table('posts', sa.column('id', sa.Integer), sa.column('body', sa.Text),
+                     sa.column('excerpt', sa.String))
+    update = posts.update().where(posts.c.id == sa.bindparam('post')) \
+                           .values(excerpt=sa.bindparam('text'))
+    bind = op.get_bind()
+    last_id = 0
+    while True:
+        rows = bind.execute(sa.select([posts.c.id, posts.c.body])
+                            .where(posts.c.id > last_id)
+                            .order_by(posts.c.id).limit(BATCH)).fetchall()
+        if not rows:
+            break
+        bind.execute(update, [{"post": post_id, "text": make_excerpt(body)}
+                              for post_id, body in rows])
+        last_id = rows[-1][0]
+
+
+def downgrade():
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('excerpt')
@@ -0,0 +1,110 @@
+"""
+Password hashing and checking off the request thread.
+
+bcrypt is deliberately slow, and running it inside the request worker lets
+a burst of logins hold the GIL and every worker thread. The work runs in a
+small process pool instead. The request thread only waits on a future,
+which releases the GIL, so reads keep being served. At most
+PASSWORD_QUEUE_DEPTH jobs may be queued or running at once; past that,
+callers get PasswordPoolBusy right away instead of piling up behind the
+pool. A caller that waits PASSWORD_TIMEOUT seconds gets it too, but its
+job keeps its place in the queue until it really ends. A worker that
+dies breaks the pool, and the next job starts a new one.
+PASSWORD_WORKERS = 0 hashes inline as before.
+"""
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask_bcrypt import generate_password_hash, check_password_hash
+from localsettings import SETTINGS
+
+LOG_ROUNDS = SETTINGS.get("BCRYPT_LOG_ROUNDS", 12)
+WORKERS = SETTINGS.get("PASSWORD_WORKERS", 2)
+QUEUE_DEPTH = SETTINGS.get("PASSWORD_QUEUE_DEPTH", 16)
+TIMEOUT = SETTINGS.get("PASSWORD_TIMEOUT", 10)
+
+
+class PasswordPoolBusy(Exception):
+    """The pool can't take or finish a password job right now: too many
+    are waiting, this one timed out, or a worker died. Worth retrying."""
+
+
+def _hash(password, rounds):
+    return generate_password_hash(password, rounds)
+
+def _check(pw_hash, password):
+    return check_password_hash(pw_hash, password)
+
+
+class PasswordPool(object):
+
+    def __init__(self, workers=WORKERS, queue_depth=QUEUE_DEPTH, timeout=TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_depth)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        # started on first use so importing the app doesn't fork workers
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _discard(self, executor):
+        # a broken pool refuses every job, so the next one starts a new pool
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(False):
+            raise PasswordPoolBusy()
+        executor = self._pool()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._discard(executor)
+            raise PasswordPoolBusy()
+        except Exception:
+            self._slots.release()
+            raise
+        # the slot is freed when the job ends, not when we stop waiting
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise PasswordPoolBusy()
+        except BrokenProcessPool:
+            self._discard(executor)
+            raise PasswordPoolBusy()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+pool = PasswordPool()
+
+def hash_password(password, rounds=None):
+    return pool.run(_hash, password, rounds or LOG_ROUNDS)
+
+def check_password(pw_hash, password):
+    if not pw_hash:
+        return False
+    return pool.run(_check, pw_hash, password)
+
+def hash_rounds(pw_hash):
+    """The cost factor a bcrypt hash ("$2b$12$...") was made with."""
+    if isinstance(pw_hash, bytes):
+        pw_hash = pw_hash.decode("ascii")
+    return int(pw_hash.split("$")[2])
+
+def needs_rehash(pw_hash):
+    return hash_rounds(pw_hash) != LOG_ROUNDS
@@ -0,0 +1,162 @@
+"""
+Query plan checks for the read and write queries that run per request.
+
+Each check calls the real query function once, records the statements it
+ran, and asks the database to explain every one of them. A table read
+from end to end fails the check:
+- on sqlite, a SCAN of a table (as opposed to a SEARCH through an index);
+- on PostgreSQL, a Seq Scan while enable_seqscan is off, which the
+  planner only picks when no index can serve the query.
+
+Scans of subqueries, CTEs and the full-text index are fine. Everything
+runs in one transaction that is rolled back, so the checks can run
+against a live database. Run them after adding a query or changing an
+index:
+
+    python manage.py check_query_plans
+
+tests/test_query_plans.py runs the same checks against an empty schema.
+"""
+import datetime as dt
+import re
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import db
+from db_models import User, Post, Relation, Vote, PostClosure, JobRun, make_url, \
+    HOT_SCORES_EPOCH
+import db_queries
+import search
+
+SQLITE_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+POSTGRES_SCAN = re.compile(r"Seq Scan on (\w+)")
+
+
+class StatementRecorder(object):
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        self.statements.append((statement, parameters))
+
+
+def plan_checks(post_id, rel_id, user_id):
+    """(name, fn) for every query checked, run against the given ids."""
+    now = dt.datetime.utcnow()
+    post_ids, rel_ids = [post_id, post_id + 1], [rel_id, rel_id + 1]
+    action_cursor = (now, "Relation", rel_id)
+    return [
+        ("child_rel_rows top", lambda: db_queries.child_rel_rows(post_id, sort_by='top')),
+        ("child_rel_rows hot", lambda: db_queries.child_rel_rows(post_id, sort_by='hot')),
+        ("child_rel_rows new", lambda: db_queries.child_rel_rows(post_id, sort_by='new')),
+        ("child_rel_rows top after",
+         lambda: db_queries.child_rel_rows(post_id, sort_by='top', after=(3, rel_id))),
+        ("child_rel_rows hot after",
+         lambda: db_queries.child_rel_rows(post_id, sort_by='hot', after=(0.5, rel_id))),
+        ("child_rel_rows new after",
+         lambda: db_queries.child_rel_rows(post_id, sort_by='new', after=(now, rel_id))),
+        ("post_action_rows", lambda: db_queries.post_action_rows(post_id, page=2)),
+        ("post_action_rows_by_cursor after",
+         lambda: db_queries.post_action_rows_by_cursor(post_id, after=action_cursor)),
+        ("post_action_rows_by_cursor before",
+         lambda: db_queries.post_action_rows_by_cursor(post_id, before=action_cursor)),
+        ("top_child_rel_ids", lambda: db_queries.top_child_rel_ids(post_ids)),
+        ("action_rows_for_pages",
+         lambda: db_queries.action_rows_for_pages([(post_id, 1), (post_id + 1, 2)])),
+        ("action_counts", lambda: db_queries.action_counts(post_ids)),
+        ("total_actions", lambda: db_queries.total_actions(post_id)),
+        ("listing_post_dicts",
+         lambda: db_queries.listing_post_dicts(post_ids, with_body=[post_id])),
+        ("post_bodies", lambda: db_queries.post_bodies(post_ids)),
+        ("rel_dicts", lambda: db_queries.rel_dicts(rel_ids)),
+        ("rel_dicts_between", lambda: db_queries.rel_dicts_between(post_ids)),
+        ("comment_dicts", lambda: db_queries.comment_dicts([1, 2])),
+        ("Vote.user_vote_values", lambda: Vote.user_vote_values(user_id, rel_ids)),
+        ("Post.get_child_relations",
+         lambda: list(Post.query.get(post_id).get_child_relations())),
+        ("Post.get_children", lambda: Post.query.get(post_id).get_children()),
+        ("Post.get_parent_relations",
+         lambda: list(Post.query.get(post_id).get_parent_relations())),
+        ("Post.get_parents", lambda: Post.query.get(post_id).get_parents()),
+        ("Post.get_comments", lambda: list(Post.query.get(post_id).get_comments())),
+        ("PostClosure.ancestors", lambda: PostClosure.ancestors(post_id, max_depth=10)),
+        ("PostClosure.descendants", lambda: PostClosure.descendants(post_id, max_depth=1)),
+        ("PostClosure.would_cycle", lambda: PostClosure.would_cycle(post_id, post_id + 1)),
+        ("PostClosure.add_edge", lambda: PostClosure.add_edge(post_id + 1, post_id)),
+        ("make_url", lambda: make_url("a title")),
+        ("Post.adjust_action_counts",
+         lambda: Post.adjust_action_counts(post_id, comments=1, links=1)),
+        ("Post.version_of", lambda: Post.version_of(post_id)),
+        ("Post.bump_versions", lambda: Post.bump_versions(post_id)),
+        ("Relation.bump_parent_versions", lambda: Relation.bump_parent_versions(rel_id)),
+        ("Relation.adjust_votecount", lambda: Relation.adjust_votecount(rel_id, 1)),
+        ("Relation.recount_votes", lambda: Relation.recount_votes(rel_id)),
+        ("Relation.refresh_hot_scores", lambda: Relation.refresh_hot_scores(rel_id)),
+        ("JobRun.last", lambda: JobRun.last(HOT_SCORES_EPOCH)),
+        ("search.search", lambda: search.search("memory energy")),
+    ]
+
+def explain(connection, statement, parameters):
+    """(detail, failed) for each line of the statement's plan."""
+    if connection.dialect.name == "sqlite":
+        rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+        details, pattern = [row[-1] for row in rows], SQLITE_SCAN
+    else:
+        rows = connection.exec_driver_sql("EXPLAIN " + statement, parameters)
+        details, pattern = [row[0] for row in rows], POSTGRES_SCAN
+    tables = set(db.metadata.tables)
+    ret = []
+    for detail in details:
+        match = pattern.search(detail)
+        failed = bool(match) and re.sub(r"_\d+$", "", match.group(1)) in tables
+        ret.append((detail, failed))
+    return ret
+
+def explain_check(connection, fn):
+    """Run fn once and explain every statement it ran, as (statement,
+    explain() of it) pairs."""
+    recorder = StatementRecorder()
+    event.listen(Engine, "before_cursor_execute", recorder)
+    try:
+        fn()
+    finally:
+        event.remove(Engine, "before_cursor_execute", recorder)
+    return [(statement, explain(connection, statement, parameters))
+            for statement, parameters in recorder.statements]
+
+def check_ids():
+    """(post_id, rel_id, user_id) to run the checks against: the first
+    post with children and the first relation and user, if any."""
+    post_id = db.session.query(Relation.parent_id).order_by(Relation.id).limit(1).scalar() \
+        or Post.root_post_id()
+    rel_id = db.session.query(Relation.id).order_by(Relation.id).limit(1).scalar() or 1
+    user_id = db.session.query(User.id).order_by(User.id).limit(1).scalar() or 1
+    return post_id, rel_id, user_id
+
+def check_query_plans(verbose=False, out=None):
+    """Explain the statements of every check. Returns the names of the
+    checks that scan a whole table."""
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+    failures = []
+    try:
+        for name, fn in plan_checks(*check_ids()):
+            plans = explain_check(connection, fn)
+            failed = any(bad for _, plan in plans for _, bad in plan)
+            if failed:
+                failures.append(name)
+            if out is not None:
+                out.write("%-36s %s\n" % (name, "FULL SCAN" if failed else "ok"))
+                for statement, plan in plans:
+                    if verbose or any(bad for _, bad in plan):
+                        out.write("    %s\n" % " ".join(statement.split()))
+                        for detail, bad in plan:
+                            out.write("      %s %s\n" % ("!" if bad else "-", detail))
+    finally:
+        db.session.rollback()
+    return failures
@@ -0,0 +1,94 @@
+"""
+Full-text search over post titles and bodies and comment bodies.
+
+The index is an SQLite FTS5 table kept current by Post.submit_post,
+Post.edit_post and Comment.submit_comment, inside the same transaction as
+the row they write. Rows are keyed so each post and comment has exactly
+one entry: rowid 2*id for posts and 2*id + 1 for comments. On databases
+other than SQLite the index functions do nothing and search finds nothing.
+"""
+import re
+from sqlalchemy import text
+from app import db
+
+RESULTS_PER_PAGE = 20
+
+def enabled():
+    return db.engine.dialect.name == "sqlite"
+
+def create_index():
+    if enabled():
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+            "title, body, kind UNINDEXED, ref_id UNINDEXED, post_id UNINDEXED, "
+            "prefix='2 3')"))
+
+def drop_index():
+    if enabled():
+        db.session.execute(text("DROP TABLE IF EXISTS search_index"))
+
+def _replace(rowid, title, body, kind, ref_id, post_id):
+    db.session.execute(text("DELETE FROM search_index WHERE rowid = :rowid"),
+                       {"rowid": rowid})
+    db.session.execute(text(
+        "INSERT INTO search_index (rowid, title, body, kind, ref_id, post_id) "
+        "VALUES (:rowid, :title, :body, :kind, :ref_id, :post_id)"),
+        {"rowid": rowid, "title": title or "", "body": body or "",
+         "kind": kind, "ref_id": ref_id, "post_id": post_id})
+
+def index_post(post):
+    """(Re)index a post. Flush first so it has an id; doesn't commit."""
+    if enabled():
+        _replace(post.id * 2, post.title, post.body, "post", post.id, post.id)
+
+def index_comment(comment):
+    """Index a comment. Flush first so it has an id; doesn't commit."""
+    if enabled():
+        _replace(comment.id * 2 + 1, None, comment.body, "comment",
+                 comment.id, comment.post_id)
+
+def rebuild_index():
+    """Reindex every post and comment. Returns the number of entries."""
+    if not enabled():
+        return 0
+    drop_index()
+    create_index()
+    db.session.execute(text(
+        "INSERT INTO search_index (rowid, title, body, kind, ref_id, post_id) "
+        "SELECT id * 2, COALESCE(title, ''), COALESCE(body, ''), 'post', id, id "
+        "FROM posts"))
+    db.session.execute(text(
+        "INSERT INTO search_index (rowid, title, body, kind, ref_id, post_id) "
+        "SELECT id * 2 + 1, '', COALESCE(body, ''), 'comment', id, post_id "
+        "FROM comments"))
+    db.session.execute(text(
+        "INSERT INTO search_index (search_index) VALUES ('optimize')"))
+    db.session.commit()
+    return db.session.execute(text("SELECT COUNT(*) FROM search_index")).scalar()
+
+def match_expression(query):
+    """Turn free text into an FTS5 query: every word must match, each as
+    a prefix. Quoting the words keeps FTS syntax out of user input."""
+    words = re.findall(r"\w+", query or "", re.UNICODE)
+    return " ".join('"%s"*' % w for w in words)
+
+def search(query, after=None, limit=RESULTS_PER_PAGE):
+    """Best matches first, as (rowid, kind, ref_id, post_id, score, snippet)
+    rows. `after` is the (score, rowid) of the last row of the previous
+    page."""
+    expression = match_expression(query)
+    if not (enabled() and expression):
+        return []
+    params = {"expression": expression, "limit": limit}
+    keyset = ""
+    if after is not None:
+        keyset = "WHERE score > :score OR (score = :score AND rowid > :rowid)"
+        params["score"], params["rowid"] = after
+    # title matches count ten times as much as body matches
+    return db.session.execute(text(
+        "SELECT rowid, kind, ref_id, post_id, score, snippet FROM ("
+        "SELECT rowid, kind, ref_id, post_id, "
+        "bm25(search_index, 10.0, 1.0) AS score, "
+        "snippet(search_index, -1, '[', ']', '...', 12) AS snippet "
+        "FROM search_index WHERE search_index MATCH :expression) "
+        + keyset + " ORDER BY score, rowid LIMIT :limit"), params).fetchall()
@@ -0,0 +1,45 @@
+"""
+Points the app at a throwaway sqlite file before anything imports it, so
+the tests never touch the configured database. Run from server/:
+
+    python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix="openthink-tests-"), "test.db")
+
+from localsettings import SETTINGS
+SETTINGS["DB_CONNECTION_STRING"] = "sqlite:///" + DB_PATH
+SETTINGS["DB_READ_CONNECTION_STRING"] = None
+SETTINGS["PASSWORD_WORKERS"] = 0
+SETTINGS["BCRYPT_LOG_ROUNDS"] = 4
+SETTINGS["HOT_SCORE_REFRESH_SECONDS"] = 0
+SETTINGS["VOTE_BUFFER_ENABLED"] = False
+
+
+@pytest.fixture(scope="session")
+def app():
+    import main
+    main.app.config["TESTING"] = True
+    return main.app
+
+
+@pytest.fixture(scope="session")
+def database(app):
+    """The schema with the admin user and the root post."""
+    from db_models import db, setup_db
+    with app.app_context():
+        setup_db(drop_tables_first=True)
+        db.session.remove()
+    return DB_PATH
+
+
+@pytest.fixture
+def client(app, database):
+    return app.test_client()
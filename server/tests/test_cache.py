@@ -0,0 +1,16 @@
+import os
+import tempfile
+
+from cache import SQLiteCache
+
+
+def test_sqlite_cache_prunes_the_least_recently_used(monkeypatch):
+    path = os.path.join(tempfile.mkdtemp(prefix="openthink-cache-"), "cache.db")
+    cache = SQLiteCache(path, maxsize=2)
+    monkeypatch.setattr(SQLiteCache, "TOUCH_EVERY", -1)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    cache.prune()
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+def test_opposite_links_at_once_cannot_close_a_cycle(app, database, monkeypatch):
+    from db_models import Post, PostClosure, Relation, User, db
+    with app.app_context():
+        admin_id = User.admin_user_id()
+        admin = User.query.get(admin_id)
+        a = Post.submit_post(admin, "one end", "Cycle A").id
+        b = Post.submit_post(admin, "other end", "Cycle B").id
+        db.session.remove()
+
+    add_edge = PostClosure.add_edge.__func__
+    checked, release = threading.Event(), threading.Event()
+    def paused_add_edge(cls, parent_id, child_id):
+        # the first link stops between its cycle check and its write
+        if parent_id == a:
+            checked.set()
+            release.wait(5)
+        add_edge(cls, parent_id, child_id)
+    monkeypatch.setattr(PostClosure, "add_edge", classmethod(paused_add_edge))
+
+    results = {}
+    def link(parent_id, child_id):
+        with app.app_context():
+            results[parent_id] = Relation.link_posts(parent_id, child_id,
+                                                     User.query.get(admin_id))
+            results[parent_id] = getattr(results[parent_id], "id", results[parent_id])
+            db.session.remove()
+    first = threading.Thread(target=link, args=(a, b))
+    second = threading.Thread(target=link, args=(b, a))
+    first.start()
+    assert checked.wait(5)
+    second.start()
+    time.sleep(0.2)
+    release.set()
+    first.join(10)
+    second.join(10)
+
+    assert isinstance(results[a], int)
+    assert results[b] == "linking these posts would create a cycle"
+    with app.app_context():
+        assert PostClosure.ancestors(a) == {}
+        assert PostClosure.ancestors(b) == {a: 1}
+
+
+def test_rebuild_in_batches_matches_the_links(app, database):
+    from db_models import Post, PostClosure, Relation, User, db
+    with app.app_context():
+        admin = User.query.get(User.admin_user_id())
+        posts = [Post.submit_post(admin, "level %d" % i, "Chain") for i in range(4)]
+        for parent, child in zip(posts, posts[1:]):
+            Relation.link_posts(parent, child, admin)
+        Relation.link_posts(posts[0], posts[3], admin)
+        def closure():
+            return set(db.session.query(PostClosure.ancestor_id, PostClosure.descendant_id,
+                                        PostClosure.depth))
+        linked = closure()
+        count = PostClosure.rebuild(batch=2)
+        assert closure() == linked
+        assert count == len(linked)
@@ -0,0 +1,29 @@
+import datetime as dt
+
+import pytest
+
+from utils import encode_cursor
+
+NOW = dt.datetime(2026, 1, 2, 3, 4, 5)
+
+
+@pytest.mark.parametrize("path, values, status", [
+    ("/links/1?sort=top", [3, 1], 200),
+    ("/links/1?sort=hot", [0.5, 1], 200),
+    ("/links/1?sort=new", [NOW, 1], 200),
+    ("/links/1?sort=top", ["3", 1], 400),
+    ("/links/1?sort=hot", [True, 1], 400),
+    ("/links/1?sort=top", [3, "1"], 400),
+    ("/links/1?sort=top", [3, 1.5], 400),
+    ("/links/1?sort=new", [3, 1], 400),
+    ("/links/1?sort=new", [NOW, None], 400),
+    ("/actions/1", [NOW, "Relation", 1], 200),
+    ("/actions/1", [NOW, 1, 1], 400),
+    ("/actions/1", [NOW, "Relation", "1"], 400),
+    ("/search?q=anything", [1.5, 2], 200),
+    ("/search?q=anything", [[1], 2], 400),
+])
+def test_cursor_values_must_match_the_sort(client, path, values, status):
+    response = client.get("%s%safter=%s" % (path, "&" if "?" in path else "?",
+                                            encode_cursor(values)))
+    assert response.status_code == status
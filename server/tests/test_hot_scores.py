@@ -0,0 +1,35 @@
+import datetime as dt
+
+
+def test_a_job_runs_once_per_interval(app, database):
+    from db_models import JobRun, db
+    with app.app_context():
+        assert JobRun.claim("test-job", 600)
+        assert not JobRun.claim("test-job", 600)
+        # what another worker sees once the interval has passed
+        db.session.execute(JobRun.__table__.update().values(
+            started_at=dt.datetime.utcnow() - dt.timedelta(seconds=601)))
+        db.session.commit()
+        assert JobRun.claim("test-job", 600)
+        assert not JobRun.claim("test-job", 600)
+
+
+def test_refresh_moves_only_hot_order_etags(app, client, database):
+    from db_models import Post, Relation, User, db
+    with app.app_context():
+        admin = User.query.get(User.admin_user_id())
+        parent = Post.submit_post(admin, "parent", "Hot parent")
+        for i in range(2):
+            Relation.link_posts(parent, Post.submit_post(admin, "child", "Hot child"), admin)
+        db.session.commit()
+        parent_id = parent.id
+        hot = "/links/%d?sort=hot" % parent_id
+        top = "/links/%d?sort=top" % parent_id
+        etags = dict((path, client.get(path).headers["ETag"]) for path in (hot, top))
+        version = Post.version_of(parent_id)
+        Relation.rebuild_hot_scores()
+        assert Post.version_of(parent_id) == version
+        response = client.get(hot, headers={"If-None-Match": etags[hot]})
+        assert response.status_code == 200
+        response = client.get(top, headers={"If-None-Match": etags[top]})
+        assert response.status_code == 304
@@ -0,0 +1,15 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+
+def test_failed_statements_leave_no_start_time_behind(app, database):
+    from app import db
+    with app.app_context():
+        connection = db.session.connection()
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.exec_driver_sql("SELECT * FROM no_such_table")
+        assert connection.info.get("metrics_started") == []
+        connection.exec_driver_sql("SELECT 1")
+        assert connection.info["metrics_started"] == []
+        db.session.rollback()
@@ -0,0 +1,45 @@
+import os
+import time
+
+import pytest
+
+from passwords import PasswordPool, PasswordPoolBusy
+
+
+def double(x):
+    return x * 2
+
+def sleep_for(seconds):
+    time.sleep(seconds)
+    return seconds
+
+def die():
+    os._exit(1)
+
+
+@pytest.fixture
+def pool():
+    pool = PasswordPool(workers=1, queue_depth=1, timeout=0.5)
+    yield pool
+    pool.shutdown()
+
+
+def test_runs_jobs_in_the_pool(pool):
+    assert pool.run(double, 21) == 42
+
+
+def test_timeout_is_busy_and_keeps_the_slot_until_the_job_ends(pool):
+    with pytest.raises(PasswordPoolBusy):
+        pool.run(sleep_for, 1.5)
+    # the timed out job is still running, so the queue is still full
+    with pytest.raises(PasswordPoolBusy):
+        pool.run(double, 1)
+    time.sleep(1.5)
+    assert pool.run(double, 1) == 2
+
+
+def test_a_dead_worker_is_busy_once_then_the_pool_recovers(pool):
+    assert pool.run(double, 1) == 2
+    with pytest.raises(PasswordPoolBusy):
+        pool.run(die)
+    assert pool.run(double, 2) == 4
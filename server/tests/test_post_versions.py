@@ -0,0 +1,36 @@
+def add_child(title):
+    from db_models import Post, Relation, User, db
+    user = User.query.get(User.admin_user_id())
+    post = Post.submit_post(user, "a body", title)
+    rel = Relation.link_posts(Post.root_post_id(), post, user)
+    db.session.commit()
+    return rel.id
+
+
+def test_writes_outside_the_views_change_the_etag(app, client):
+    from db_models import Relation, db
+    with app.app_context():
+        rel_id = add_child("versioned")
+        etag = client.get("/links/1").headers["ETag"]
+        assert client.get("/links/1", headers={"If-None-Match": etag}).status_code == 304
+        # drift the stored total the way a crashed writer could, then repair it
+        db.session.execute("UPDATE relations SET votecount = 5 WHERE id = %d" % rel_id)
+        db.session.commit()
+        assert Relation.reconcile_votecounts() == 1
+        response = client.get("/links/1", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+
+def test_cached_state_follows_a_version_bumped_by_another_process(app):
+    from db_models import Post, db
+    from views import handle_asks
+    with app.app_context(), app.test_request_context():
+        rel_id = add_child("shared")
+        before = handle_asks(1, ["children"])
+        assert before["rels"][rel_id]["votecount"] == 0
+        # what another worker's write leaves behind: the row and the version
+        db.session.execute("UPDATE relations SET votecount = 3 WHERE id = %d" % rel_id)
+        db.session.execute("UPDATE posts SET version = version + 1 WHERE id = 1")
+        db.session.commit()
+        assert handle_asks(1, ["children"])["rels"][rel_id]["votecount"] == 3
@@ -0,0 +1,44 @@
+"""
+Every per-request query in query_plans.plan_checks must reach posts,
+relations, comments and votes through an index, never a full SCAN. The
+schema is the one the models create, in the tests' temporary sqlite file,
+so a query or index change that loses an index fails here.
+"""
+import pytest
+
+import query_plans
+
+CHECK_NAMES = [name for name, _ in query_plans.plan_checks(1, 1, 1)]
+NO_SCAN_TABLES = ("posts", "relations", "comments", "votes")
+
+
+@pytest.fixture(scope="module")
+def ids(app, database):
+    """A parent with a child link, a vote and a comment to check against."""
+    from db_models import Comment, Post, Relation, User, Vote, db
+    with app.app_context():
+        admin = User.query.get(User.admin_user_id())
+        child = Post.submit_post(admin, "memory and energy", "Plan child")
+        rel = Relation.link_posts(Post.root_post_id(), child, admin)
+        Vote.submit_vote(admin, rel, 1)
+        Comment.submit_comment(admin, Post.root_post_id(), "plan comment")
+        db.session.commit()
+        return query_plans.check_ids()
+
+
+@pytest.mark.parametrize("name", CHECK_NAMES)
+def test_query_reads_no_whole_table(app, ids, name):
+    from app import db
+    with app.app_context():
+        connection = db.session.connection()
+        try:
+            fn = dict(query_plans.plan_checks(*ids))[name]
+            plans = query_plans.explain_check(connection, fn)
+        finally:
+            db.session.rollback()
+    assert plans, "%s ran no statements" % name
+    scans = ["%s\n    %s" % (" ".join(statement.split()), detail)
+             for statement, plan in plans for detail, _ in plan
+             if query_plans.SQLITE_SCAN.match(detail) and
+             query_plans.SQLITE_SCAN.match(detail).group(1) in NO_SCAN_TABLES]
+    assert not scans, "\n".join(scans)
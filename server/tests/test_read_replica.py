@@ -0,0 +1,44 @@
+import shutil
+from io import StringIO
+
+import pytest
+from transit.reader import Reader
+
+
+def read_json(response):
+    return Reader("json").read(StringIO(response.data.decode("utf-8")))
+
+
+@pytest.fixture
+def lagging_replica(app, database):
+    """A "read" bind frozen at a copy of the database as it is now."""
+    import app as app_module
+    replica = database + ".replica"
+    shutil.copy(database, replica)
+    app_module.SQLALCHEMY_BINDS["read"] = "sqlite:///" + replica
+    app.config["SQLALCHEMY_BINDS"] = app_module.SQLALCHEMY_BINDS
+    yield replica
+    with app.app_context():
+        app_module.db.get_engine(app, bind="read").dispose()
+    del app_module.SQLALCHEMY_BINDS["read"]
+
+
+def test_etag_and_cached_state_read_the_primary(app, client, lagging_replica):
+    from db_models import Comment
+    with app.app_context():
+        etag = client.get("/actions/1").headers["ETag"]
+        before = read_json(client.get("/post-by-id/1?data-only=1"))["action_count"]
+        Comment.submit_comment(1, 1, "only on the primary")
+        response = client.get("/actions/1", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert read_json(response)["action_count"] == before + 1
+        state = read_json(client.get("/post-by-id/1?data-only=1"))
+        assert state["action_count"] == before + 1
+
+
+def test_other_gets_still_read_the_replica(app, client, lagging_replica):
+    from db_models import Post, User
+    with app.app_context():
+        post = Post.submit_post(User.query.get(1), "written after the copy", "Late post")
+        response = client.get("/post-bodies?ids=%d" % post.id)
+        assert read_json(response)["bodies"] == {}
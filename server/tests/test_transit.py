@@ -0,0 +1,43 @@
+from io import BytesIO, StringIO
+
+from transit.reader import Reader
+
+
+def read_json(data):
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    return Reader("json").read(StringIO(data))
+
+
+def test_consecutive_json_encodes_on_one_thread_decode(app):
+    from views import transit_encoder
+    first = transit_encoder.encode({"a": 1}, "json")
+    second = transit_encoder.encode({"a": 2}, "json")
+    assert read_json(first) == {"a": 1}
+    assert read_json(second) == {"a": 2}
+
+
+def test_consecutive_msgpack_encodes_on_one_thread_decode(app):
+    from views import transit_encoder
+    first = transit_encoder.encode({"a": 1}, "msgpack")
+    second = transit_encoder.encode({"a": [2, 3]}, "msgpack")
+    assert Reader("msgpack").read(BytesIO(first)) == {"a": 1}
+    assert Reader("msgpack").read(BytesIO(second)) == {"a": (2, 3)}
+
+
+def test_consecutive_json_responses_from_one_thread_decode(client):
+    # the test client serves every request on the calling thread
+    responses = [client.get("/links/1"), client.get("/actions/1"), client.get("/links/1")]
+    for response in responses:
+        assert response.status_code == 200
+        state = read_json(response.data)
+        assert "rels" in state
+
+
+def test_writer_failure_does_not_poison_the_next_msgpack_encode(app):
+    from views import transit_encoder
+    try:
+        transit_encoder.encode({"a": object()}, "msgpack")
+    except Exception:
+        pass
+    assert Reader("msgpack").read(BytesIO(transit_encoder.encode([1], "msgpack"))) == (1,)
@@ -0,0 +1,75 @@
+from io import StringIO
+
+import pytest
+from transit.reader import Reader
+from transit.writer import Writer
+
+
+def transit(value):
+    io = StringIO()
+    Writer(io, "json").write(value)
+    return io.getvalue().encode("utf-8")
+
+def read_json(response):
+    return Reader("json").read(StringIO(response.data.decode("utf-8")))
+
+
+@pytest.fixture
+def buffered(app, monkeypatch):
+    import vote_buffer
+    from db_models import Vote
+    # a long interval, so nothing flushes during the test
+    buffer = vote_buffer.VoteBuffer(app, interval_ms=60000)
+    monkeypatch.setattr(vote_buffer, "buffer", buffer)
+    monkeypatch.setattr(Vote, "buffer", buffer)
+    yield buffer
+    buffer.stop()
+
+
+def test_buffered_vote_changes_the_voters_etag(app, client, buffered):
+    from db_models import Post, Relation, User, db
+    with app.app_context():
+        admin = User.query.get(User.admin_user_id())
+        post = Post.submit_post(admin, "buffered body", "Buffered")
+        rel_id = Relation.link_posts(Post.root_post_id(), post, admin).id
+        User.create(username="buffered", email="buffered@example.com", password="password1")
+        db.session.commit()
+        version = Post.version_of(Post.root_post_id())
+    anonymous = app.test_client()
+    anonymous_etag = anonymous.get("/links/1").headers["ETag"]
+    client.post("/login", data=transit({"username": "buffered", "password": "password1"}))
+    response = client.get("/links/1")
+    etag = response.headers["ETag"]
+    assert read_json(response)["rels"][rel_id]["user_vote_value"] == 0
+    client.post("/vote", data=transit({"rel_id": rel_id, "value": 1}))
+    assert buffered.pending
+    response = client.get("/links/1", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert read_json(response)["rels"][rel_id]["user_vote_value"] == 1
+    # nobody else's cached state moves until the flush
+    with app.app_context():
+        assert Post.version_of(Post.root_post_id()) == version
+    response = anonymous.get("/links/1", headers={"If-None-Match": anonymous_etag})
+    assert response.status_code == 304
+    # taking the vote back is the original state again
+    client.post("/vote", data=transit({"rel_id": rel_id, "value": 1}))
+    assert not buffered.pending and not buffered.user_rels
+    response = client.get("/links/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_flushed_votes_move_the_post_version(app, client, buffered):
+    from db_models import Post, Relation, User, db
+    with app.app_context():
+        admin = User.query.get(User.admin_user_id())
+        post = Post.submit_post(admin, "flushed body", "Flushed")
+        rel_id = Relation.link_posts(Post.root_post_id(), post, admin).id
+        User.create(username="flushed", email="flushed@example.com", password="password1")
+        db.session.commit()
+        version = Post.version_of(Post.root_post_id())
+    client.post("/login", data=transit({"username": "flushed", "password": "password1"}))
+    client.post("/vote", data=transit({"rel_id": rel_id, "value": -1}))
+    assert buffered.flush() == 1
+    assert not buffered.user_rels
+    with app.app_context():
+        assert Post.version_of(Post.root_post_id()) > version
@@ -0,0 +1,49 @@
+import pytest
+
+
+@pytest.fixture
+def rel_id(app, database):
+    from db_models import Post, Relation, User, db
+    with app.app_context():
+        admin = User.query.get(User.admin_user_id())
+        post = Post.submit_post(admin, "something to vote on", "Votes")
+        rel = Relation.link_posts(Post.root_post_id(), post, admin)
+        voters = [User.create(username="voter%d.%d" % (rel.id, i),
+                              email="v%d.%d@example.com" % (rel.id, i),
+                              password="password1") for i in range(3)]
+        db.session.commit()
+        yield rel.id, [voter.id for voter in voters]
+
+
+def stored_and_counted(rel_id):
+    from db_models import Relation, Vote, db
+    db.session.expire_all()
+    stored = Relation.query.get(rel_id).votecount
+    counted = sum(v.value for v in Vote.query.filter(Vote.rel_id==rel_id))
+    return stored, counted
+
+
+def test_every_vote_transition_keeps_the_stored_total(app, rel_id):
+    from db_models import Vote
+    rel_id, (a, b, c) = rel_id
+    with app.app_context():
+        steps = [(a, 1, 1, 1), (b, 1, 1, 2), (a, -1, -1, 0), (c, -1, -1, -1),
+                 (a, -1, 0, 0), (b, -1, -1, -2), (c, 1, 1, 0), (c, 1, 0, -1)]
+        for user_id, value, result, total in steps:
+            assert Vote.submit_vote(user_id, rel_id, value) == result
+            assert stored_and_counted(rel_id) == (total, total)
+
+
+def test_upsert_rows_without_native_upsert(app, rel_id, monkeypatch):
+    import db_models
+    from db_models import Vote, db, upsert_rows
+    rel_id, (a, b, c) = rel_id
+    with app.app_context():
+        Vote.submit_vote(a, rel_id, 1)
+        monkeypatch.setattr(db_models, "UPSERT_DIALECTS", {})
+        upsert_rows(Vote.__table__, [{"rel_id": rel_id, "user_id": a, "value": -1},
+                                     {"rel_id": rel_id, "user_id": b, "value": 1}],
+                    ("rel_id", "user_id"))
+        db.session.commit()
+        values = dict((v.user_id, v.value) for v in Vote.query.filter(Vote.rel_id==rel_id))
+        assert values == {a: -1, b: 1}
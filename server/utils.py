@@ -1,6 +1,11 @@
+import datetime as dt
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from flask.globals import _app_ctx_stack, _request_ctx_stack
 from werkzeug.urls import url_parse
 
+CURSOR_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
 def is_number(s):
     try:
         float(s)
@@ -8,6 +13,27 @@ def is_number(s):
     except ValueError:
         return False
 
+def encode_cursor(values):
+    """Pack a list of sort-key values into an opaque url-safe token."""
+    values = [v.strftime(CURSOR_TIME_FORMAT) if isinstance(v, dt.datetime) else v
+              for v in values]
+    token = urlsafe_b64encode(json.dumps(values).encode("utf-8"))
+    return token.decode("ascii").rstrip("=")
+
+def decode_cursor(token, time_fields=()):
+    """Unpack a token made by encode_cursor, parsing the values at
+    time_fields back into datetimes. Raises ValueError for bad tokens."""
+    try:
+        raw = urlsafe_b64decode(str(token) + "=" * (-len(token) % 4))
+        values = json.loads(raw.decode("utf-8"))
+        for i in time_fields:
+            values[i] = dt.datetime.strptime(values[i], CURSOR_TIME_FORMAT)
+    except (TypeError, IndexError, KeyError, UnicodeDecodeError):
+        raise ValueError("malformed cursor %r" % token)
+    if not isinstance(values, list):
+        raise ValueError("malformed cursor %r" % token)
+    return values
+
 def route_from(url, method = None):
     appctx = _app_ctx_stack.top
     reqctx = _request_ctx_stack.top
@@ -28,4 +54,4 @@ def route_from(url, method = None):
     parsed_url = url_parse(url)
     if parsed_url.netloc is not "" and parsed_url.netloc != url_adapter.server_name:
         raise FileNotFoundError
-    return url_adapter.match(parsed_url.path, method)
\ No newline at end of file
+    return url_adapter.match(parsed_url.path, method)
\ No newline at end of file
@@ -1,129 +1,447 @@
 from flask import Blueprint, Flask, request, session, g, redirect, url_for, abort, \
-     render_template, flash, jsonify
-from db_models import User, Post, Relation, Comment, Vote
-from db_queries import child_rel_query, post_actions, total_actions
-from utils import is_number, route_from
+     render_template, flash, jsonify, make_response, Response, has_request_context
+from app import primary_reads
+from db_models import User, Post, Relation, Comment, Vote, PostClosure, JobRun, \
+     unit_of_work, HOT_SCORES_EPOCH
+from db_queries import child_rel_rows, post_action_rows, \
+     post_action_rows_by_cursor, total_actions, action_cursor, links_cursor, \
+     top_child_rel_ids, action_rows_for_pages, action_counts, \
+     listing_post_dicts, post_bodies, rel_dicts, rel_dicts_between, comment_dicts, \
+     rel_writeable, with_vote_values
+from utils import is_number, route_from, encode_cursor, decode_cursor
 from transit.writer import Writer
 from transit.reader import Reader
 from io import StringIO, BytesIO
 from localsettings import SETTINGS
-from six import string_types
+from cache import LRUCache, cache
+import events
+import search
+import vote_buffer
+from passwords import PasswordPoolBusy
+from six import string_types, integer_types
+import datetime as dt
 import math
+import hashlib
+import threading
 from flask_login import login_user, logout_user, login_required, current_user
 from sqlalchemy.orm.exc import NoResultFound
 
 blueprint = Blueprint('views', __name__)
 
 ACTIONS_PER_PAGE = 20
+MAX_GRAPH_DEPTH = 10
+MAX_GRAPH_POSTS = 500
+MAX_BATCH_ASKS = 50
+MAX_BODY_IDS = 50
+EVENTS_HEARTBEAT_SECONDS = SETTINGS.get("EVENTS_HEARTBEAT_SECONDS", 15)
+EVENTS_RETRY_MS = 5000
 
-def transitify(val, format='json'):
-    io = StringIO()
-    writer = Writer(io, format) # or "json-verbose", "msgpack"
-    writer.write(val)
-    return io.getvalue()
+TRANSIT_MIMETYPES = {"json": "application/transit+json",
+                     "msgpack": "application/transit+msgpack"}
+
+class TransitEncoder(threading.local):
+    """Keeps one msgpack Writer and buffer per thread, so a response
+    doesn't pay for building the writer and its handler tables. json gets
+    a fresh Writer every time: its marshaler remembers that it already
+    wrote a value and would put a separator in front of the next one."""
+
+    def __init__(self):
+        self.msgpack = None
+
+    def encode(self, val, format):
+        if format != "msgpack":
+            io = StringIO()
+            Writer(io, format).write(val)
+            return io.getvalue()
+        if self.msgpack is None:
+            io = BytesIO()
+            self.msgpack = (io, Writer(io, format))
+        io, writer = self.msgpack
+        io.seek(0)
+        io.truncate()
+        writer.marshaler.packer.reset()
+        try:
+            writer.write(val)
+        except Exception:
+            # don't reuse a writer left halfway through a value
+            self.msgpack = None
+            raise
+        return io.getvalue()
+
+transit_encoder = TransitEncoder()
+
+def preferred_transit_format():
+    """msgpack for clients that ask for it in Accept, json otherwise."""
+    if not has_request_context():
+        return "json"
+    best = request.accept_mimetypes.best_match(
+        [TRANSIT_MIMETYPES["json"], TRANSIT_MIMETYPES["msgpack"]])
+    return "msgpack" if best == TRANSIT_MIMETYPES["msgpack"] else "json"
+
+def transitify(val, format=None):
+    if format is None:
+        format = preferred_transit_format()
+    if format == "msgpack":
+        return Response(transit_encoder.encode(val, format),
+                        mimetype=TRANSIT_MIMETYPES["msgpack"])
+    return transit_encoder.encode(val, format)
 
 def writable_current_user():
     if not current_user.is_anonymous:
         return current_user.writeable
     return None
 
+def conditional_response(post_id, build, hot_order=False):
+    """Respond with build() under a strong ETag derived from the version
+    stored on the post, or with a bare 304 when the client already holds
+    that ETag, without calling build at all. Both read the primary, so
+    the body is never older than the version in its ETag. The user's
+    votes still waiting in the vote buffer are part of the ETag too: they
+    show in the body but don't move the version until they're flushed.
+    With hot_order the body depends on hot scores, which the periodic
+    refresh rewrites without moving post versions, so the ETag carries
+    the refresh epoch as well."""
+    user_id = None if current_user.is_anonymous else current_user.id
+    pending = ()
+    if vote_buffer.buffer is not None and user_id is not None:
+        pending = vote_buffer.buffer.pending_votes(user_id)
+    variant = "%s|%s|%r|%s|%r" % (request.full_path, user_id, request.data,
+                                  preferred_transit_format(), pending)
+    with primary_reads():
+        if hot_order:
+            variant += "|%s" % JobRun.last(HOT_SCORES_EPOCH)
+        etag = "p%s-v%s-%s" % (post_id, Post.version_of(post_id),
+                               hashlib.sha1(variant.encode("utf-8")).hexdigest()[:16])
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = make_response(build())
+    response.set_etag(etag)
+    # the body depends on the session's votes, so shared caches must not
+    # keep it and browsers must revalidate every time
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
+
 def dict_by_id(alist, key="id"):
     return dict([(item[key], item) for item in alist])
 
-def actions_with_data(post_id, page):
-    actions = post_actions(post_id, page=int(page))
-    posts = []
-    rels = [(a[0]) for a in actions if a[1] == "Relation"]
-    if rels:
-        rels = Relation.query.filter(Relation.id.in_(rels))
-        posts = Post.query.filter(
-            Post.id.in_([r.child_id for r in rels]))
-    comments = [(a[0]) for a in actions if a[1] == "Comment"]
-    if comments:
-        comments = Comment.query.filter(Comment.id.in_(comments))
+NUMBER = integer_types + (float,)
+# (time, "Relation" or "Comment", id), as made by db_queries.action_cursor
+ACTION_CURSOR = (dt.datetime, string_types, integer_types)
+
+def cursor_arg(name, types, time_fields=()):
+    """Decode the cursor in query arg `name`, or None if it wasn't sent.
+    types holds the type (or tuple of types) of each value; a cursor of
+    another length or with a value of another type is a 400."""
+    token = request.args.get(name)
+    if token is None:
+        return None
+    try:
+        cursor = decode_cursor(token, time_fields)
+    except ValueError:
+        abort(400)
+    if len(cursor) != len(types):
+        abort(400)
+    for value, kind in zip(cursor, types):
+        if isinstance(value, bool) or not isinstance(value, kind):
+            abort(400)
+    return cursor
+
+def actions_with_data(post_id, page, after=None, before=None, user=current_user):
+    if after is not None or before is not None:
+        rows = post_action_rows_by_cursor(post_id, after=after, before=before)
+        page = None
+    else:
+        rows = post_action_rows(post_id, page=int(page))
+        page = int(page)
+    actions = [[row[0], row[2]] for row in rows]
+    rels = rel_dicts([a[0] for a in actions if a[1] == "Relation"])
     return {
         "actions": actions, 
-        "rels": [r.writeable_with_vote_info(current_user) for r in rels], 
-        "posts": [p.writeable for p in posts], 
-        "comments": [c.writeable for c in comments],
-        "page": int(page)
+        "rels": with_vote_values(rels, user), 
+        "posts": listing_post_dicts([r["child_id"] for r in rels]), 
+        "comments": comment_dicts([a[0] for a in actions if a[1] == "Comment"]),
+        "page": page,
+        "prev_cursor": action_cursor(rows[0]) if rows else None,
+        "next_cursor": action_cursor(rows[-1]) if rows else None
     }
 
+def vote_overlay(state, user):
+    """Copy of cached asks state with user's own votes filled in."""
+    rels = state.get("rels")
+    if not rels:
+        return dict(state)
+    vote_values = Vote.user_vote_values(user, list(rels))
+    ret = dict(state)
+    ret["rels"] = dict((rel_id, dict(rel, user_vote_value=vote_values.get(rel_id, 0)))
+                       for rel_id, rel in rels.items())
+    return ret
+
 def handle_asks(post, list_of_wants, page=None):
-    post = Post.query.filter(Post.id==post).one() if isinstance(post, int) else post
-    ret = {"current_post": post.id, "rels": {}, "posts": {}}
+    """Answer asks for one post. The user-independent part is cached per
+    post version, and built from the primary so it's no older than that
+    version; the current user's votes are merged in afterwards."""
+    post_id = post if isinstance(post, int) else post.id
+    with primary_reads():
+        if "actions" in list_of_wants:
+            if page is None: # set page to the last page if not given
+                page = math.ceil(float(total_actions(post_id)) / float(ACTIONS_PER_PAGE))
+            page = int(page)
+        key = "asks:%s:%s:%s:%s" % (post_id, ",".join(sorted(list_of_wants)), page,
+                                    Post.version_of(post_id))
+        state = cache.get(key)
+        if state is None:
+            state = build_asks(post, list_of_wants, page)
+            cache.set(key, state)
+    return vote_overlay(state, current_user)
+
+def build_asks(post, list_of_wants, page=None):
+    post_id = post if isinstance(post, int) else post.id
+    ret = {"current_post": post_id, "rels": {}, "posts": {}}
     if "children" in list_of_wants:
-        rels = child_rel_query(post.id)
-        child_ids = [rel.child_id for rel in rels]
-        children = []
-        if child_ids:
-            children = Post.query.filter(Post.id.in_(child_ids)).all()
-        child_posts = [p.writeable for p in children]
+        rels = child_rel_rows(post_id)
+        posts = dict_by_id(listing_post_dicts([r.child_id for r in rels] + [post_id],
+                                              with_body=[post_id]))
+        if post_id not in posts:
+            raise NoResultFound("no post %s" % post_id)
         ret["link_ids"] = [r.id for r in rels]
-        rels = [r.writeable_with_vote_info(current_user) for r in rels]
-        ret["posts"].update(dict_by_id(child_posts + [post.writeable]))
-        ret["rels"].update(dict_by_id(rels))
+        ret["links_cursor"] = links_cursor(rels[-1]) if rels else None
+        ret["posts"].update(posts)
+        ret["rels"].update(dict_by_id(with_vote_values([rel_writeable(r) for r in rels])))
+    elif isinstance(post, int):
+        Post.query.filter(Post.id==post_id).with_entities(Post.id).one()
 
     if "actions" in list_of_wants:
-        action_count = total_actions(post.id)
+        action_count = total_actions(post_id)
         if page is None: # set page to the last page if not given
             page = math.ceil(float(action_count) / float(ACTIONS_PER_PAGE))
-        action_info = actions_with_data(post.id, page)
+        action_info = actions_with_data(post_id, page, user=None)
         ret["actions"] = action_info["actions"]
         ret["rels"].update(dict_by_id(action_info["rels"]))
         ret["posts"].update(dict_by_id(action_info["posts"]))
         ret["action_count"] = action_count
         ret["page"] = int(page)
         ret["comments"] = dict_by_id(action_info["comments"])
+        ret["prev_cursor"] = action_info["prev_cursor"]
+        ret["next_cursor"] = action_info["next_cursor"]
 
     return ret
 
 @blueprint.route('/actions/<int:post_id>')
 def actions_endpoint(post_id):
-    action_count = total_actions(post_id)
-    page = request.args.get('page', math.ceil(float(action_count) / 
-                                              float(ACTIONS_PER_PAGE)))
-    print("page is %s" % page)
-    action_info = actions_with_data(post_id, page)
-    return transitify({
-        "actions": action_info["actions"], 
-        "action_count": action_count, 
-        "posts": dict_by_id(action_info["posts"]),
-        "rels": dict_by_id(action_info["rels"]),
-        "comments": dict_by_id(action_info["comments"]),
-        "page": int(page)
-    })
+    def build():
+        action_count = total_actions(post_id)
+        page = request.args.get('page', math.ceil(float(action_count) / 
+                                                  float(ACTIONS_PER_PAGE)))
+        action_info = actions_with_data(post_id, page,
+                                        after=cursor_arg('after', ACTION_CURSOR, time_fields=(0,)),
+                                        before=cursor_arg('before', ACTION_CURSOR,
+                                                          time_fields=(0,)))
+        return transitify({
+            "actions": action_info["actions"], 
+            "action_count": action_count, 
+            "posts": dict_by_id(action_info["posts"]),
+            "rels": dict_by_id(action_info["rels"]),
+            "comments": dict_by_id(action_info["comments"]),
+            "page": action_info["page"],
+            "prev_cursor": action_info["prev_cursor"],
+            "next_cursor": action_info["next_cursor"]
+        })
+    return conditional_response(post_id, build)
 
 @blueprint.route('/links/<int:post_id>')
 def links_endpoint(post_id):
-    sort_by = request.args.get('sort', 'top')
-    page = request.args.get('page', 0)
-    rels = child_rel_query(post_id, page=int(page), sort_by=sort_by)
-    posts = []
-    if rels:
-        posts = Post.query.filter(Post.id.in_([r.child_id for r in rels])).all()
-    return transitify({
-        "posts": dict_by_id([p.writeable for p in posts]), 
-        "rels": dict_by_id(
-            [r.writeable_with_vote_info(current_user) for r in rels]), 
-        "new_rel_ids": [r.id for r in rels]
-    })
+    def build():
+        sort_by = request.args.get('sort', 'top')
+        page = request.args.get('page', 0)
+        if sort_by in ('top', 'hot'):
+            after = cursor_arg('after', (NUMBER, integer_types))
+        else:
+            after = cursor_arg('after', (dt.datetime, integer_types),
+                               time_fields=(0,))
+        rels = child_rel_rows(post_id, page=int(page), sort_by=sort_by, after=after)
+        return transitify({
+            "posts": dict_by_id(listing_post_dicts([r.child_id for r in rels])), 
+            "rels": dict_by_id(
+                with_vote_values([rel_writeable(r) for r in rels], current_user)), 
+            "new_rel_ids": [r.id for r in rels],
+            "next_cursor": links_cursor(rels[-1], sort_by) if rels else None
+        })
+    return conditional_response(post_id, build,
+                                hot_order=request.args.get('sort') == 'hot')
 
 @blueprint.route('/post-by-id/<int:post_id>')
 def render_post(post_id):
-    print ("post is %s" % post_id)
-    req_data = get_post_data_from_req(request)
-    page = req_data.get("page", math.ceil(float(total_actions(post_id)) / 
-                                          float(ACTIONS_PER_PAGE)))
     data_only = request.args.get('data-only')
-    print ("page is %s" % page)
-    app_state = handle_asks(post_id, ["children", "actions"], page=page)
-    app_state["user"] = writable_current_user()
-    print (app_state)
+    def build():
+        req_data = get_post_data_from_req(request)
+        page = req_data.get("page")
+        app_state = handle_asks(post_id, ["children", "actions"], page=page)
+        app_state["user"] = writable_current_user()
+        return app_state
     if not data_only: 
         return render_template('base.html', debug=SETTINGS["DEBUG"],
-                                app_state=transitify(app_state))
-    return transitify(app_state)
+                                app_state=transitify(build(), "json"))
+    return conditional_response(post_id, lambda: transitify(build()))
+
+@blueprint.route('/post-bodies')
+def post_bodies_endpoint():
+    """Full bodies of the posts in ?ids=1,2,3, for expanding the excerpts
+    that listings send in place of bodies."""
+    try:
+        post_ids = [int(i) for i in request.args.get('ids', '').split(',') if i]
+    except ValueError:
+        abort(400)
+    if len(post_ids) > MAX_BODY_IDS:
+        abort(400)
+    return transitify({"bodies": post_bodies(post_ids)})
+
+def graph_state(post_id, depths):
+    """Posts at the given depths from post_id plus every relation among
+    them, so the client can draw the whole path or subtree at once."""
+    post_ids = list(depths) + [post_id]
+    posts = listing_post_dicts(post_ids, with_body=[post_id])
+    if not any(p["id"] == post_id for p in posts):
+        abort(404)
+    return {
+        "current_post": post_id,
+        "depths": depths,
+        "posts": dict_by_id(posts),
+        "rels": dict_by_id(with_vote_values(rel_dicts_between(post_ids), current_user))
+    }
+
+@blueprint.route('/post/<int:post_id>/ancestors')
+def ancestors_endpoint(post_id):
+    depth = min(request.args.get('depth', MAX_GRAPH_DEPTH, type=int), MAX_GRAPH_DEPTH)
+    return transitify(graph_state(post_id, PostClosure.ancestors(
+        post_id, max_depth=depth, limit=MAX_GRAPH_POSTS)))
+
+@blueprint.route('/post/<int:post_id>/descendants')
+def descendants_endpoint(post_id):
+    depth = min(request.args.get('depth', 1, type=int), MAX_GRAPH_DEPTH)
+    return transitify(graph_state(post_id, PostClosure.descendants(
+        post_id, max_depth=depth, limit=MAX_GRAPH_POSTS)))
+
+def server_event(kind, data, seq):
+    return "id: %d\nevent: %s\ndata: %s\n\n" % (seq, kind,
+                                                  transit_encoder.encode(data, "json"))
+
+@blueprint.route('/post/<int:post_id>/events')
+def post_events(post_id):
+    """Server-Sent Events with the post's new comments ("comment"), links
+    ("relation") and vote totals ("votes") as transit json. A "reset"
+    means events were lost and the client should re-fetch the post. A
+    comment line goes out every EVENTS_HEARTBEAT_SECONDS when idle."""
+    if Post.query.filter(Post.id==post_id).with_entities(Post.id).first() is None:
+        abort(404)
+    subscriber = events.hub.subscribe(post_id,
+                                      request.headers.get("Last-Event-ID", type=int))
+    if subscriber is None:
+        return Response(status=503, headers={"Retry-After": "30"})
+    def stream():
+        # runs after the request is torn down, so it holds no session
+        try:
+            yield "retry: %d\n\n" % EVENTS_RETRY_MS
+            while True:
+                items, overflowed, seq = subscriber.wait(EVENTS_HEARTBEAT_SECONDS)
+                if overflowed:
+                    # the re-fetch covers whatever else is queued
+                    yield server_event("reset", {"post_id": post_id}, seq)
+                elif items:
+                    for item in items:
+                        yield server_event(item[1], item[2], item[0])
+                else:
+                    yield ": heartbeat\n\n"
+        finally:
+            events.hub.unsubscribe(subscriber)
+    response = Response(stream(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # keep nginx from buffering the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+@blueprint.route('/search')
+def search_endpoint():
+    after = cursor_arg('after', (NUMBER, integer_types))
+    rows = search.search(request.args.get('q'), after=after)
+    post_ids = set(row.post_id for row in rows)
+    comment_ids = [row.ref_id for row in rows if row.kind == "comment"]
+    return transitify({
+        "results": [{"kind": row.kind, "id": row.ref_id, "post_id": row.post_id,
+                     "snippet": row.snippet} for row in rows],
+        "posts": dict_by_id(listing_post_dicts(post_ids)),
+        "comments": dict_by_id(comment_dicts(comment_ids)),
+        "next_cursor": encode_cursor([rows[-1].score, rows[-1].rowid])
+                       if len(rows) == search.RESULTS_PER_PAGE else None
+    })
+
+def read_batch_asks(req_data):
+    """Validate a /batch body into a list of (post_id, wants, page)."""
+    if not isinstance(req_data, (list, tuple)) or len(req_data) > MAX_BATCH_ASKS:
+        abort(400)
+    asks = []
+    for ask in req_data:
+        try:
+            post_id = int(ask.get("post_id"))
+            wants = [w for w in ask.get("asks", ["children", "actions"])
+                     if w in ("children", "actions")]
+            page = ask.get("page")
+            page = None if page is None else int(page)
+        except (AttributeError, TypeError, ValueError):
+            abort(400)
+        asks.append((post_id, wants, page))
+    return asks
+
+@blueprint.route("/batch", methods=["POST"])
+def batch_endpoint():
+    """Answer the asks of many posts at once. Every kind of row is fetched
+    with one query over all the posts involved, and the posts, rels and
+    comments come back as shared maps the per-post results refer into."""
+    asks = read_batch_asks(get_post_data_from_req(request))
+    post_ids = set(post_id for post_id, _, _ in asks)
+    counts = action_counts(post_ids) if post_ids else {}
+    asks = [ask for ask in asks if ask[0] in counts]
+
+    child_ids = set(post_id for post_id, wants, _ in asks if "children" in wants)
+    links = top_child_rel_ids(child_ids) if child_ids else {}
+    pages = {}
+    for post_id, wants, page in asks:
+        if "actions" in wants:
+            if page is None: # the last page, like handle_asks
+                page = math.ceil(float(counts[post_id]) / float(ACTIONS_PER_PAGE))
+            pages[(post_id, int(page) or 1)] = None
+    actions = action_rows_for_pages(pages) if pages else {}
+
+    rel_ids = set(rel_id for ids in links.values() for rel_id in ids)
+    comment_ids = set()
+    for rows in actions.values():
+        rel_ids.update(row[0] for row in rows if row[2] == "Relation")
+        comment_ids.update(row[0] for row in rows if row[2] == "Comment")
+    rels = rel_dicts(rel_ids)
+    asked_ids = set(post_id for post_id, _, _ in asks)
+    post_ids.update(rel["child_id"] for rel in rels)
+
+    results = []
+    for post_id, wants, page in asks:
+        result = {"post_id": post_id}
+        if "children" in wants:
+            result["link_ids"] = links[post_id]
+        if "actions" in wants:
+            if page is None:
+                page = math.ceil(float(counts[post_id]) / float(ACTIONS_PER_PAGE))
+            rows = actions[(post_id, int(page) or 1)]
+            result["actions"] = [[row[0], row[2]] for row in rows]
+            result["action_count"] = counts[post_id]
+            result["page"] = int(page)
+        results.append(result)
+    return transitify({
+        "results": results,
+        "posts": dict_by_id(listing_post_dicts(post_ids, with_body=asked_ids)),
+        "rels": dict_by_id(with_vote_values(rels, current_user)),
+        "comments": dict_by_id(comment_dicts(comment_ids)),
+        "user": writable_current_user()
+    })
 
 @blueprint.route('/')
 def index():
@@ -132,13 +450,16 @@ def index():
 
 @blueprint.route('/post/<post_url>')
 def post_page(post_url):
-    try:
-        p_id = Post.query.filter(Post.url==post_url) \
-                         .with_entities(Post.id).one()[0]
-    except NoResultFound:
+    p_id = Post.id_for_url(post_url)
+    if p_id is None:
         abort(404)
     return render_post(p_id)
 
+@blueprint.before_app_first_request
+def preload_url_cache():
+    if SETTINGS.get("URL_CACHE_PRELOAD"):
+        Post.preload_url_cache()
+
 def get_post_data_from_req(request):
     if not request.data:
         return {}
@@ -148,7 +469,10 @@ def get_post_data_from_req(request):
 @blueprint.route("/login", methods=["POST"])
 def login():
     req_data = get_post_data_from_req(request)
-    user = User.login_user(req_data.get("username"), req_data.get("password"))
+    try:
+        user = User.login_user(req_data.get("username"), req_data.get("password"))
+    except PasswordPoolBusy:
+        return transitify({"error": "Too many logins right now, try again"}), 503
     if user:
         login_user(user)
         return transitify({"username": user.username, "id": user.id})
@@ -164,10 +488,13 @@ def logout():
 @blueprint.route("/register", methods=["POST"])
 def register():
     req_data = get_post_data_from_req(request)
-    user = User.register_user(req_data.get("username"), 
-                              req_data.get("email"),
-                              req_data.get("password"),
-                              req_data.get("r-password"))
+    try:
+        user = User.register_user(req_data.get("username"), 
+                                  req_data.get("email"),
+                                  req_data.get("password"),
+                                  req_data.get("r-password"))
+    except PasswordPoolBusy:
+        return transitify({"error": "Too many sign ups right now, try again"}), 503
     if isinstance(user, str):
         return transitify({"error": user})
     login_user(user)
@@ -176,40 +503,49 @@ def register():
 @blueprint.route("/submit-post", methods=["POST"])
 def submit_post():
     req_data = get_post_data_from_req(request)
-    post = Post.submit_post(current_user,
-                     req_data.get("text"),
-                     req_data.get("title"))
-    if isinstance(post, str):
-        return transitify({"error": post, "error_type": "create-post"})
-
-    post_id = req_data.get('parent', Post.root_post_id())
-    relation = Relation.link_posts(post_id, 
-                                   post, 
-                                   current_user)
-    if isinstance(relation, str):
-        return transitify({"error": relation, "error_type": "link-posts"})
+    # the post and its link commit together, so a failed link can't
+    # leave an orphan post behind
+    with unit_of_work:
+        post = Post.submit_post(current_user,
+                         req_data.get("text"),
+                         req_data.get("title"))
+        if isinstance(post, str):
+            return transitify({"error": post, "error_type": "create-post"})
+
+        post_id = req_data.get('parent', Post.root_post_id())
+        relation = Relation.link_posts(post_id, 
+                                       post, 
+                                       current_user)
+        if isinstance(relation, str):
+            unit_of_work.rollback()
+            return transitify({"error": relation, "error_type": "link-posts"})
 
     app_state = {"success": "posted successfully"}
     if req_data.get('current_post') and req_data.get('ask_for'):
-        page = req_data.get("page", math.ceil(float(total_actions(post_id)) / 
-                                              float(ACTIONS_PER_PAGE)))
+        page = req_data.get("page")
         app_state.update(handle_asks(req_data.get('current_post'), 
                                     req_data.get('ask_for'), page))
     return transitify(app_state)
 
+# (host, text) -> (endpoint, post_id or post_url) for recent link texts,
+# so pasting the same url again skips route matching
+link_target_cache = LRUCache(maxsize=SETTINGS.get("LINK_TEXT_CACHE_SIZE", 4096))
+
 def get_post_id_from_text(s):
     if is_number(s):
         return int(s)
-    rt = route_from(s, method="GET")
-    if rt[0] == 'views.render_post':
-        return rt[1]['post_id']
-    elif rt[0] == 'views.post_page':
-        try:
-            return Post.query.filter(Post.url==rt[1]['post_url']) \
-                             .with_entities(Post.id).one()[0]
-        except NoResultFound:
-            return None
-    elif rt[0] == 'views.index':
+    key = (request.host, s)
+    target = link_target_cache.get(key)
+    if target is None:
+        endpoint, args = route_from(s, method="GET")
+        target = (endpoint, args.get('post_id', args.get('post_url')))
+        link_target_cache.set(key, target)
+    endpoint, arg = target
+    if endpoint == 'views.render_post':
+        return arg
+    elif endpoint == 'views.post_page':
+        return Post.id_for_url(arg)
+    elif endpoint == 'views.index':
         return Post.root_post_id()
 
 @blueprint.route("/link-post", methods=["POST"])
@@ -219,15 +555,13 @@ def link_post():
     relation = "Post not found"
     child_id = get_post_id_from_text(req_data.get('child-text'))
     if child_id:
-        print("linking post %s" % child_id)
         relation = Relation.link_posts(parent_id, child_id, current_user)
     if isinstance(relation, str):
         return transitify({"error": relation})
 
     app_state = {"success": "linked successfully"}
     if req_data.get('current_post') and req_data.get('ask_for'):
-        page = req_data.get("page", math.ceil(float(total_actions(parent_id)) / 
-                                              float(ACTIONS_PER_PAGE)))
+        page = req_data.get("page")
         app_state.update(handle_asks(req_data.get('current_post'), 
                                      req_data.get('ask_for'), page))
     return transitify(app_state)
@@ -245,8 +579,17 @@ def submit_comment(post_id):
 @blueprint.route("/vote", methods=["POST"])
 def submit_vote():
     req_data = get_post_data_from_req(request)
-    vote = Vote.submit_vote(current_user, int(req_data.get('rel_id')), int(req_data.get('value')))
+    rel_id = int(req_data.get('rel_id'))
+    if vote_buffer.buffer is not None:
+        # answered from the buffer and written by the flusher shortly;
+        # until then the vote is in the voter's ETags, not the post version
+        rel = Relation.query.filter(Relation.id==rel_id).one()
+        vote, delta = vote_buffer.buffer.submit(current_user.id, rel_id,
+                                                int(req_data.get('value')))
+        return transitify({"rel": dict(rel.writeable, votecount=rel.votecount + delta,
+                                       user_vote_value=vote)})
+    vote = Vote.submit_vote(current_user, rel_id, int(req_data.get('value')))
     if isinstance(vote, str):
         return transitify({"error": vote})
-    rel = Relation.query.filter(Relation.id==int(req_data.get('rel_id'))).one()
-    return transitify({"rel": rel.writeable_with_vote_info()})
+    rel = Relation.query.filter(Relation.id==rel_id).one()
+    return transitify({"rel": dict(rel.writeable, user_vote_value=vote)})
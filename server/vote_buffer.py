@@ -0,0 +1,207 @@
+"""
+Optional write-behind buffer for votes, on when SETTINGS["VOTE_BUFFER_ENABLED"].
+
+/vote puts the vote in an in-process buffer keyed by (relation, user)
+and answers straight away. The buffer keeps the value the vote started
+from and the value it should end at, so any number of toggles by one
+user on one relation collapse into at most one row write, or none when
+they cancel out. A background thread writes everything pending in one
+transaction every VOTE_BUFFER_INTERVAL_MS, or sooner once
+VOTE_BUFFER_MAX_PENDING votes are waiting, and at interpreter exit.
+Each flush is a batched DELETE and a batched upsert, then one recount
+and hot_score refresh of the touched relations and one version bump of
+their parents.
+
+Until its flush, a vote is visible to its own voter, through
+Vote.user_vote_values, and in the vote count returned by /vote. The
+voter's ETags include their pending votes (pending_votes), so their
+next revalidation gets the new vote rather than a 304, without a write
+per vote. Other readers and other worker processes see it after the
+flush, so they are at most one interval behind.
+"""
+import atexit
+import logging
+import os
+import threading
+
+from sqlalchemy import bindparam
+
+from app import app, db
+from db_models import Relation, Vote, unit_of_work, upsert_rows
+from localsettings import SETTINGS
+
+log = logging.getLogger("openthink.votes")
+
+
+class VoteBuffer(object):
+
+    def __init__(self, app, interval_ms=200, max_pending=5000):
+        self.app = app
+        self.interval = interval_ms / 1000.0
+        self.max_pending = max_pending
+        # (rel_id, user_id) -> [value before, value after]; 0 is no vote
+        self.pending = {}
+        self.flushing = {}
+        # rel_id -> what the buffered votes add to the stored votecount
+        self.deltas = {}
+        # user_id -> rel_ids of the user's votes in pending or flushing
+        self.user_rels = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stopped = False
+
+    def _known(self, key):
+        entry = self.pending.get(key) or self.flushing.get(key)
+        return None if entry is None else entry[1]
+
+    def _forget(self, keys):
+        """Drop keys no longer buffered from user_rels; hold _lock."""
+        for key in keys:
+            if key in self.pending or key in self.flushing:
+                continue
+            rel_id, user_id = key
+            rels = self.user_rels.get(user_id)
+            if rels is not None:
+                rels.discard(rel_id)
+                if not rels:
+                    del self.user_rels[user_id]
+
+    def submit(self, user_id, rel_id, value):
+        """Buffer a vote, or take it back if the user's current vote has
+        the same value. Returns the user's vote value afterwards and the
+        buffered change to the relation's vote count."""
+        value = 1 if value == 1 else -1
+        key = (rel_id, user_id)
+        self.start()
+        stored = None
+        while True:
+            with self._lock:
+                current = self._known(key)
+                if current is None:
+                    current = stored
+                if current is not None:
+                    target = 0 if current == value else value
+                    entry = self.pending.setdefault(key, [current, target])
+                    entry[1] = target
+                    self.user_rels.setdefault(user_id, set()).add(rel_id)
+                    if entry[0] == entry[1]:
+                        del self.pending[key]
+                        self._forget([key])
+                    delta = self.deltas.get(rel_id, 0) + target - current
+                    if delta:
+                        self.deltas[rel_id] = delta
+                    else:
+                        self.deltas.pop(rel_id, None)
+                    full = len(self.pending) >= self.max_pending
+                    break
+            # nothing buffered for this vote, so the table has the truth
+            stored = db.session.query(Vote.value) \
+                               .filter((Vote.rel_id==rel_id) & (Vote.user_id==user_id)) \
+                               .scalar() or 0
+        if full:
+            self._wake.set()
+        return target, delta
+
+    def pending_values(self, user_id, rel_ids):
+        """The user's buffered vote values among rel_ids."""
+        with self._lock:
+            return dict((rel_id, target) for rel_id, target in
+                        ((rel_id, self._known((rel_id, user_id))) for rel_id in rel_ids)
+                        if target is not None)
+
+    def pending_votes(self, user_id):
+        """The user's buffered votes as sorted (rel_id, value) pairs."""
+        with self._lock:
+            return sorted((rel_id, self._known((rel_id, user_id)))
+                          for rel_id in self.user_rels.get(user_id, ()))
+
+    def flush(self):
+        """Write everything pending. Returns the number of votes written."""
+        with self._flush_lock:
+            with self._lock:
+                if not self.pending:
+                    return 0
+                batch = self.flushing = self.pending
+                self.pending = {}
+            try:
+                with self.app.app_context():
+                    self._write(batch)
+            except Exception:
+                log.exception("flushing %d buffered votes failed, will retry", len(batch))
+                with self._lock:
+                    for key, (base, target) in batch.items():
+                        entry = self.pending.setdefault(key, [base, target])
+                        entry[0] = base
+                        if entry[0] == entry[1]:
+                            del self.pending[key]
+                    self.flushing = {}
+                    self._forget(batch)
+                return 0
+            with self._lock:
+                for (rel_id, _), (base, target) in batch.items():
+                    delta = self.deltas.get(rel_id, 0) - (target - base)
+                    if delta:
+                        self.deltas[rel_id] = delta
+                    else:
+                        self.deltas.pop(rel_id, None)
+                self.flushing = {}
+                self._forget(batch)
+            return len(batch)
+
+    def _write(self, batch):
+        table = Vote.__table__
+        removed = [{"r": rel_id, "u": user_id}
+                   for (rel_id, user_id), (_, target) in batch.items() if not target]
+        changed = [{"rel_id": rel_id, "user_id": user_id, "value": target}
+                   for (rel_id, user_id), (_, target) in batch.items() if target]
+        rel_ids = set(rel_id for rel_id, _ in batch)
+        with unit_of_work:
+            if removed:
+                db.session.execute(table.delete().where(
+                    (table.c.rel_id==bindparam("r")) & (table.c.user_id==bindparam("u"))),
+                    removed)
+            upsert_rows(table, changed, ("rel_id", "user_id"))
+            Relation.recount_votes(*rel_ids)
+            Relation.refresh_hot_scores(*rel_ids)
+            Relation.bump_parent_versions(*rel_ids)
+            Relation.publish_votecounts(*rel_ids)
+
+    def start(self):
+        """Start the flusher in this process if it isn't running; after a
+        fork the child starts its own."""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            if self._thread is None:
+                atexit.register(self.stop)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="vote-flusher")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def stop(self):
+        """Stop the flusher and write whatever is still pending."""
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.interval * 10)
+        self.flush()
+
+
+buffer = None
+if SETTINGS.get("VOTE_BUFFER_ENABLED"):
+    buffer = Vote.buffer = VoteBuffer(
+        app, interval_ms=SETTINGS.get("VOTE_BUFFER_INTERVAL_MS", 200),
+        max_pending=SETTINGS.get("VOTE_BUFFER_MAX_PENDING", 5000))